@@ -20,10 +20,8 @@ import sys
 from os.path import join,dirname, exists, basename, splitext
 from os import makedirs
 from copy import copy
-from codecs import open
 from urllib import urlopen
 
-import yaml
 import requests
 from requests.auth import HTTPBasicAuth
 import json
@@ -34,7 +32,11 @@ from manuallabour.exporters.html import SinglePageHTMLExporter
 from manuallabour.exporters.gantt import GanttExporter
 from manuallabour.exporters.svg import GraphSVGExporter, ScheduleSVGExporter
 
-from manufac.utils import FileCache
+from manufac.utils import FileCache, RenderError, JobQueue, parse_size, new_stats
+from manufac.utils import SharedCache
+from manufac.utils import load_yaml
+from manufac.importers.openscad import run_worker, cancel_on_sigterm
+from manufac.importers.common import IncludeCycleError
 
 import pkg_resources
 
@@ -48,36 +50,239 @@ def cli():
     pass
 
 @cli.command()
+@click.option('--orphans',is_flag=True,default=False)
 @click.argument('input_file',type=click.Path(exists=True))
-def clean(input_file):
+def clean(orphans,input_file):
+    """
+    Clear the cache, or with --orphans only remove files that are not used
+    by the last render of any document
+    """
     basedir = dirname(input_file)
 
     #clear cache
     cachedir = join(basedir,'.mlcache')
     if exists(cachedir):
         with FileCache(cachedir) as fc:
-            fc.clear()
+            if orphans:
+                removed = fc.remove_orphans()
+                if removed is None:
+                    print "No render recorded yet, render the documents first"
+                else:
+                    print "Removed %d files" % len(removed)
+            else:
+                fc.clear()
+
+@cli.group()
+def cache():
+    """
+    Manage the cache
+    """
+    pass
 
+@cache.command()
+@click.option('--max-size',default=None)
+@click.option('--max-entries',type=click.IntRange(0),default=None)
+@click.option('--shared-cache',envvar='MANUFAC_SHARED_CACHE',
+    type=click.Path(file_okay=False),default=None)
+@click.option('--shared-max-size',default=None)
+@click.option('--queue',envvar='MANUFAC_QUEUE',
+    type=click.Path(file_okay=False),default=None)
+@click.argument('input_file',type=click.Path(exists=True))
+def gc(max_size,max_entries,shared_cache,shared_max_size,queue,input_file):
+    """
+    Evict the least recently used files from the cache and the shared cache,
+    and remove the files in the job queue that no job needs any more
+    """
+    cachedir = join(dirname(input_file),'.mlcache')
+    if exists(cachedir):
+        with FileCache(cachedir) as fc:
+            evicted = fc.gc(parse_size(max_size),max_entries)
+        print "Evicted %d files" % len(evicted)
+    if shared_cache is not None and exists(shared_cache):
+        shared = SharedCache(shared_cache)
+        try:
+            removed = shared.gc(parse_size(shared_max_size))
+        finally:
+            shared.close()
+        print "Removed %d shared objects" % len(removed)
+    if queue is not None and exists(queue):
+        removed = JobQueue(queue).gc()
+        print "Removed %d queued files" % len(removed)
+
+@cache.command()
+@click.option('--json','as_json',is_flag=True,default=False)
+@click.option('--slowest',type=click.IntRange(0),default=5)
+@click.argument('input_file',type=click.Path(exists=True))
+def stats(as_json,slowest,input_file):
+    """
+    Show hit and miss statistics of the last render and in total, and the
+    slowest renders
+    """
+    cachedir = join(dirname(input_file),'.mlcache')
+    data = dict(last=new_stats(),total=new_stats(),slowest=[])
+    if exists(cachedir):
+        with FileCache(cachedir) as fc:
+            for key in ['last','total']:
+                data[key] = fc.journal('stats').get(key,data[key])
+            durations = fc.journal('durations').data.values()
+            durations.sort(reverse=True)
+            data["slowest"] = durations[:slowest]
+
+    if as_json:
+        print json.dumps(data)
+        return
+
+    for key, title in [('last','Last render'),('total','Total')]:
+        stat = data[key]
+        misses = sum(stat["misses"].values())
+        lookups = stat["hits"] + misses
+        print "%s:" % title
+        print "  hits:            %d of %d (%.1f%%)" % (
+            stat["hits"],
+            lookups,
+            100.*stat["hits"]/lookups if lookups else 0.
+        )
+        print "  misses:          %d" % misses
+        for reason, count in sorted(stat["misses"].iteritems()):
+            print "    %-20s %d" % (reason.replace('_',' ') + ':',count)
+        print "  shared hits:     %d" % stat["shared_hits"]
+        print "  failures:        %d (%d cached)" % (
+            stat["failures"],
+            stat["cached_failures"]
+        )
+        print "  callback time:   %.1f s" % stat["callback_time"]
+        print "  bytes written:   %d" % stat["bytes_written"]
+
+    if data["slowest"]:
+        print "Slowest renders:"
+    for duration, inputs in data["slowest"]:
+        print "  %8.1f s  %s" % (
+            duration,
+            ", ".join("%s=%s" % item for item in sorted(inputs.iteritems()))
+        )
+
+@cli.command()
+@click.option('--json','as_json',is_flag=True,default=False)
+@click.option('-j','--jobs',type=click.IntRange(1),default=1)
+@click.option('--check',type=click.Choice(['mtime','content']),default='mtime')
+@click.option('--shared-cache',envvar='MANUFAC_SHARED_CACHE',
+    type=click.Path(file_okay=False),default=None)
+@click.option('--failure-backoff',type=click.FloatRange(0),default=None)
+@click.option('--geometry-cache',is_flag=True,default=False)
+@click.argument('input_file',type=click.Path(exists=True))
+def plan(as_json,jobs,check,shared_cache,failure_backoff,geometry_cache,
+        input_file):
+    """
+    Show which files a render would create and how long it would take,
+    without creating them
+    """
+    targets = yaml_loader.plan_graph(
+        input_file,
+        importer_options={'openscad' : dict(geometry=geometry_cache)},
+        check=check,
+        shared=shared_cache,
+        failure_backoff=failure_backoff
+    )
+
+    if as_json:
+        print json.dumps(targets)
+        return
+
+    stale = [t for t in targets if t["state"] == 'stale']
+    estimates = [t["estimate"] for t in stale if not t["estimate"] is None]
+    for t in stale:
+        print "  %10s  %-20s %s" % (
+            "?" if t["estimate"] is None else "%.1f s" % t["estimate"],
+            t["reason"].replace('_',' '),
+            ", ".join("%s=%s" % item for item in sorted(t["inputs"].iteritems()))
+        )
+
+    counts = {}
+    for t in targets:
+        counts[t["state"]] = counts.get(t["state"],0) + 1
+    print "%d files: %s" % (
+        len(targets),
+        ", ".join("%d %s" % (counts.get(state,0),state)
+            for state in ['fresh','stale','shared','failed'])
+    )
+    print "Estimated render time: %.1f s (%.1f s with %d jobs)%s" % (
+        sum(estimates),
+        sum(estimates)/jobs,
+        jobs,
+        ", %d without estimate" % (len(stale) - len(estimates))
+            if len(stale) > len(estimates) else ""
+    )
 
 @cli.command()
 @click.option('-o','--output',type=click.Path(exists=False,file_okay=False,dir_okay=True),default='docs')
 @click.option('-f','--format',type=click.Choice(['html','ttn']),default='html')
 @click.option('-l','--layout',default='basic')
+@click.option('-j','--jobs',type=click.IntRange(1),default=1)
+@click.option('--check',type=click.Choice(['mtime','content']),default='mtime')
+@click.option('--cache-max-size',default=None)
+@click.option('--cache-max-entries',type=click.IntRange(0),default=None)
+@click.option('--shared-cache',envvar='MANUFAC_SHARED_CACHE',
+    type=click.Path(file_okay=False),default=None)
+@click.option('--failure-backoff',type=click.FloatRange(0),default=None)
+@click.option('--stats',is_flag=True,default=False)
+@click.option('--progress/--no-progress',default=sys.stderr.isatty())
+@click.option('--geometry-cache',is_flag=True,default=False)
+@click.option('--queue',envvar='MANUFAC_QUEUE',
+    type=click.Path(file_okay=False),default=None)
+@click.option('--renderer',default='openscad')
+@click.option('--scratch',envvar='MANUFAC_SCRATCH',
+    type=click.Path(exists=True,file_okay=False),default=None)
+@click.option('--timeout',type=click.FloatRange(0),default=None)
+@click.option('--memory-limit',default=None)
+@click.option('-k','--keep-going',is_flag=True,default=False)
 @click.argument('input_file',type=click.Path(exists=True))
-def render(output,format,layout,input_file):
+def render(output,format,layout,jobs,check,cache_max_size,cache_max_entries,
+        shared_cache,failure_backoff,stats,progress,geometry_cache,queue,
+        renderer,scratch,timeout,memory_limit,keep_going,input_file):
     """
-    Render the instructions
+    Render the instructions. With --queue, all renders are sent to the
+    workers at once, regardless of --jobs.
     """
+    cancel_on_sigterm()
     store = LocalMemoryStore()
 
     ext = splitext(input_file)[1]
     if ext == ".yaml":
-        inst = list(yaml.load_all(open(input_file,"r","utf8")))[0]
-        graph = yaml_loader.load_graph(input_file,store)
-        title = inst["title"]
+        cache_stats = new_stats()
+        try:
+            graph = yaml_loader.load_graph(
+                input_file,
+                store,
+                importer_options={'openscad' : dict(
+                    geometry=geometry_cache,
+                    queue=queue,
+                    renderer=renderer,
+                    scratch=scratch,
+                    timeout=timeout,
+                    memory=parse_size(memory_limit)
+                )},
+                stats=cache_stats,
+                #the local jobs only wait for the workers
+                jobs=None if queue is not None else jobs,
+                check=check,
+                max_bytes=parse_size(cache_max_size),
+                max_entries=cache_max_entries,
+                shared=shared_cache,
+                failure_backoff=failure_backoff,
+                progress=progress,
+                keep_going=keep_going
+            )
+        except (RenderError,IncludeCycleError) as e:
+            raise click.ClickException(str(e))
+        #already parsed while loading the graph
+        title = load_yaml(input_file)["title"]
     elif ext == ".pv":
         basedir = dirname(input_file)
-        graph = pv_loader.load_graph(input_file,store,basedir)
+        cachedir = join(basedir,'.mlcache')
+        if not exists(cachedir):
+            makedirs(cachedir)
+        with FileCache(cachedir) as cache:
+            graph = pv_loader.load_graph(input_file,store,basedir,cache)
         title = "Test"
 
     try:
@@ -106,6 +311,34 @@ def render(output,format,layout,input_file):
 
         e.export(s,store,join(output,'tracker.json'),**data)
 
+    if stats and ext == ".yaml":
+        #statistics of the cache during this render
+        print json.dumps(cache_stats)
+
+@cli.command()
+@click.option('--poll',type=click.FloatRange(0),default=1.)
+@click.option('--once',is_flag=True,default=False)
+@click.option('--renderer',default='openscad')
+@click.option('--scratch',envvar='MANUFAC_SCRATCH',
+    type=click.Path(exists=True,file_okay=False),default=None)
+@click.option('--timeout',type=click.FloatRange(0),default=None)
+@click.option('--memory-limit',default=None)
+@click.argument('queue',type=click.Path(file_okay=False))
+def worker(poll,once,renderer,scratch,timeout,memory_limit,queue):
+    """
+    Render the jobs that are sent to a queue directory by render --queue
+    """
+    cancel_on_sigterm()
+    run_worker(
+        JobQueue(queue),
+        poll,
+        once,
+        renderer,
+        scratch,
+        timeout,
+        parse_size(memory_limit)
+    )
+
 @cli.command()
 @click.option('-h','--host',default='http://flask.dev:5000/')
 @click.option('--username',prompt=True)
@@ -117,7 +350,7 @@ def upload(host,username,password,input_file,graph_name):
     Upload the instruction to a cadinet
     """
 
-    inst = list(yaml.load_all(open(input_file,"r","utf8")))[0]
+    inst = load_yaml(input_file)
 
     store = LocalMemoryStore()
 
@@ -17,13 +17,16 @@
 
 from manuallabour.core.graph import Graph, GraphStep
 import pkg_resources
+import os
 import re
 import json
+import hashlib
 import jsonschema
 from codecs import open
 
 from os.path import join,dirname, exists, abspath, splitext, basename
-import yaml
+
+from manufac.utils import open_blob, load_yaml
 
 import manuallabour.core.common as common
 
@@ -72,24 +75,204 @@ def format_time(time):
     return " ".join(res)
 
 
+#bundled schemas by URL and compiled validators by schema name, loaded
+#once per process
+_schemas = {}
+_validators = {}
+_schema_version = None
+
+def _schema_url(schema_name):
+    return 'file://' + abspath(join(schema_dir,schema_name))
+
+def _load_schemas():
+    if not _schemas:
+        for name in os.listdir(schema_dir):
+            if splitext(name)[1] == '.json':
+                with open(join(schema_dir,name),'r','utf8') as fid:
+                    _schemas[_schema_url(name)] = json.loads(fid.read())
+    return _schemas
+
+def get_validator(schema_name):
+    """
+    returns the validator for one of the bundled schemas. References to
+    the other bundled schemas are resolved without reading them again.
+    """
+    if not schema_name in _validators:
+        schemas = _load_schemas()
+        url = _schema_url(schema_name)
+        res = jsonschema.RefResolver(url,schemas[url],store=schemas)
+        _validators[schema_name] = \
+            jsonschema.Draft4Validator(schemas[url],resolver=res)
+    return _validators[schema_name]
+
 def validate(inst,schema_name):
-    schema_path = abspath(join(schema_dir,schema_name))
-    schema = json.loads(open(schema_path).read())
-    res = jsonschema.RefResolver('file://' + schema_path,schema)
-    val = jsonschema.Draft4Validator(schema,resolver=res)
-    val.validate(inst)
+    get_validator(schema_name).validate(inst)
+
+def schema_version():
+    """
+    returns a digest of the bundled schemas and the version of jsonschema,
+    that changes whenever the result of a validation might change
+    """
+    global _schema_version
+    if _schema_version is None:
+        m = hashlib.sha1(jsonschema.__version__)
+        for url, schema in sorted(_load_schemas().iteritems()):
+            m.update(basename(url))
+            m.update(json.dumps(schema,sort_keys=True))
+        _schema_version = m.hexdigest()
+    return _schema_version
+
+def validate_document(inputfile,inst,cache):
+    """
+    validate a document against the bundled schema, unless it was
+    validated successfully before and neither the file nor the schemas
+    changed since then. The results are remembered in the FileCache,
+    unless it is read only.
+    """
+    key = abspath(inputfile)
+    version = [cache.digest(inputfile),schema_version()]
+    if cache.journal('validated').get(key) == version:
+        return
+    validate(inst,'ml.json')
+    if not cache.read_only:
+        cache.journal('validated').set(key,version)
+
+class IncludeCycleError(Exception):
+    """
+    Raised if a document includes itself, directly or indirectly. cycle
+    is the list of documents in the cycle.
+    """
+    def __init__(self,cycle):
+        Exception.__init__(self,"Include cycle: %s" % " -> ".join(cycle))
+        self.cycle = cycle
+
+def load_documents(inputfile,cache=None):
+    """
+    returns a list of (filename, instructions) tuples for a YAML document
+    and all documents included by it, directly or indirectly. Each document
+    is listed once. The documents are loaded with load_yaml and validated,
+    so that invalid documents fail before anything is hashed or rendered.
+    Raises IncludeCycleError if a document includes itself, directly or
+    indirectly.
+    """
+    documents = []
+    visited = set([])
+
+    def visit(filename,loading):
+        path = abspath(filename)
+        if path in loading:
+            raise IncludeCycleError(loading[loading.index(path):] + [path])
+        if path in visited:
+            return
+        visited.add(path)
+
+        inst = load_yaml(filename,cache)
+        if cache is None:
+            validate(inst,'ml.json')
+        else:
+            validate_document(filename,inst,cache)
+        documents.append((filename,inst))
+        for alias, include in inst.get("include",{}).iteritems():
+            visit(join(dirname(filename),include),loading + [path])
+
+    visit(inputfile,[])
+    return documents
+
+def blob_index(cache):
+    """
+    returns the DigestIndex of the blob ids in a FileCache
+    """
+    return cache.index('blob_ids',common.calculate_blob_checksum)
+
+def document_blobs(documents):
+    """
+    returns the paths of the images and files in a list of (filename,
+    instructions) tuples
+    """
+    paths = []
+    for filename, inst in documents:
+        for step in inst["steps"].itervalues():
+            for i_dict in step.get("images",{}).itervalues():
+                paths.append(i_dict["filename"])
+            for f_dict in step.get("files",{}).itervalues():
+                paths.append(f_dict["path"])
+    return paths
+
+def add_blob(store,path,cache=None):
+    """
+    add the file at path to the store if it is not already there, and
+    return its blob id. If a FileCache is given, the blob ids are
+    remembered in it, so that unchanged files are hashed only once.
+    """
+    if cache is None:
+        with open_blob(path) as fid:
+            blob_id = common.calculate_blob_checksum(fid)
+    else:
+        blob_id = blob_index(cache).digest(path)
+    if not store.has_blob(blob_id):
+        store.add_blob(blob_id,path)
+    return blob_id
+
+def _requirements(steps,step_ids):
+    """
+    returns the set of the ids of the given steps and all steps they
+    require, directly or indirectly, from a list of step dictionaries
+    """
+    requires = dict((step["step_id"],step["requires"]) for step in steps)
+    res = set([])
+    pending = list(step_ids)
+    while pending:
+        step_id = pending.pop()
+        if step_id in res:
+            continue
+        res.add(step_id)
+        pending += requires.get(step_id,[])
+    return res
+
+class IncludeRegistry(object):
+    """
+    Scaffoldings of the documents of a build by absolute path and content
+    digest, so that a document that is included several times is only
+    scaffolded once and shared by all documents including it.
+    """
+    def __init__(self):
+        self.scaffoldings = {}
+        #documents whose includes are being loaded
+        self.loading = []
+
+    def get(self,inputfile,store,filecache,importers):
+        """
+        returns the GraphScaffolding for an included document
+        """
+        path = abspath(inputfile)
+        if path in self.loading:
+            raise IncludeCycleError(self.loading[self.loading.index(path):] + [path])
+        key = (path,filecache.digest(path))
+        if not key in self.scaffoldings:
+            self.scaffoldings[key] = GraphScaffolding(
+                inputfile,
+                store,
+                filecache,
+                importers,
+                self
+            )
+        return self.scaffoldings[key]
 
 class GraphScaffolding(object):
     """
     Class to build up a graph. Holds the raw data from the YAML and
-    coordinates the importers.
+    coordinates the importers. Includes are loaded through an
+    IncludeRegistry, which is shared with the scaffoldings of the includes.
     """
-    def __init__(self,inputfile,store,filecache,importers):
+    def __init__(self,inputfile,store,filecache,importers,registry=None):
         self.store = store
         self.cache = filecache
+        self.registry = registry or IncludeRegistry()
+        self._steps = None
+        self._graph = None
 
-        inst = list(yaml.load_all(open(inputfile,"r","utf8")))[0]
-        validate(inst,'ml.json')
+        inst = load_yaml(inputfile,filecache)
+        validate_document(inputfile,inst,filecache)
 
         basedir = dirname(inputfile)
 
@@ -101,13 +284,17 @@ class GraphScaffolding(object):
 
         #load includes
         self.include = {}
-        for alias, filename in inst.get("include",{}).iteritems():
-            self.include[alias] = GraphScaffolding(
-                join(basedir,filename),
-                store,
-                filecache,
-                importers
-            )
+        self.registry.loading.append(abspath(inputfile))
+        try:
+            for alias, filename in inst.get("include",{}).iteritems():
+                self.include[alias] = self.registry.get(
+                    join(basedir,filename),
+                    store,
+                    filecache,
+                    importers
+                )
+        finally:
+            self.registry.loading.pop()
 
         #parse base syntax
         for alias, raw in self.steps_raw.iteritems():
@@ -191,26 +378,37 @@ class GraphScaffolding(object):
             ref["requires"] = list(ref["requires"])
 
 
+    def _graph_steps(self):
+        """
+        returns the list of step dictionaries of the graph, the steps of
+        this document followed by the steps of the includes that are
+        required by them, directly or indirectly
+        """
+        if self._steps is None:
+            steps = []
+            #from this graph scaffolding
+            for alias,step in self.graph_steps.iteritems():
+                steps.append(dict(step_id=self.step_ids[alias],**step))
+
+            #from includes
+            seen = set(step["step_id"] for step in steps)
+            for scaf, step_ids in self.included_steps.iteritems():
+                inc_steps = self.include[scaf]._graph_steps()
+                required = _requirements(inc_steps,step_ids)
+                for step in inc_steps:
+                    if step["step_id"] in required and \
+                            not step["step_id"] in seen:
+                        seen.add(step["step_id"])
+                        steps.append(step)
+            self._steps = steps
+        return self._steps
+
     def get_graph(self):
-        steps = []
-        #from this graph scaffolding
-        for alias,step in self.graph_steps.iteritems():
-            steps.append(dict(step_id=self.step_ids[alias],**step))
-
-        #from includes
-        for scaf, step_ids in self.included_steps.iteritems():
-            inc_steps = set([])
-            graph = self.include[scaf].get_graph()
-            for step_id in step_ids:
-                inc_steps.add(step_id)
-                inc_steps.update(graph.all_ancestors(step_id))
-
-            for graph_step in graph.steps:
-                if graph_step.step_id in inc_steps:
-                    steps.append(graph_step.as_dict())
-
-        graph_id = Graph.calculate_checksum(steps=steps)
-        return Graph(graph_id=graph_id,steps=steps)
+        if self._graph is None:
+            steps = self._graph_steps()
+            graph_id = Graph.calculate_checksum(steps=steps)
+            self._graph = Graph(graph_id=graph_id,steps=steps)
+        return self._graph
 
     def _object_from_YAML(self,inst,created=False):
         # Object Reference properties
@@ -243,10 +441,7 @@ class GraphScaffolding(object):
     def _file_from_YAML(self,inst):
         path = inst["path"]
         filename = basename(path)
-        with open(path,'rb') as fid:
-            blob_id = common.calculate_blob_checksum(fid)
-        if not self.store.has_blob(blob_id):
-            self.store.add_blob(blob_id,path)
+        blob_id = add_blob(self.store,path,self.cache)
 
         return dict(blob_id=blob_id,filename=filename)
 
@@ -255,10 +450,7 @@ class GraphScaffolding(object):
         ext = splitext(path)[1]
         alt = inst.get("alt","")
 
-        with open(path,'rb') as fid:
-            blob_id = common.calculate_blob_checksum(fid)
-        if not self.store.has_blob(blob_id):
-            self.store.add_blob(blob_id,path)
+        blob_id = add_blob(self.store,path,self.cache)
 
         return dict(blob_id=blob_id,extension=ext,alt=alt)
 
@@ -290,6 +482,22 @@ class ImporterBase(object):
         """
         self.key = key
 
+    def prepare(self,cache,documents):
+        """
+        Create the files needed for a list of (filename, instructions)
+        tuples in advance, so that identical requests from different
+        documents are only processed once.
+        """
+        pass
+
+    def plan(self,cache,documents):
+        """
+        Return a list with the status of the files this importer would
+        create for a list of (filename, instructions) tuples, see
+        FileCache.status.
+        """
+        return []
+
     def process(self,scaf):
         """
         Process graph
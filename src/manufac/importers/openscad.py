@@ -15,224 +15,867 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from manufac.importers.common import ImporterBase
-from tempfile import mkstemp
-from subprocess import call
+from manufac.importers.common import ImporterBase, add_blob, blob_index
+from manufac.utils import RenderError, Cancelled, JobQueue, parse_size
+from tempfile import mkstemp, mkdtemp, gettempdir, TemporaryFile
+from subprocess import Popen
+from time import sleep, time
+from random import Random
 import os
+import re
+import errno
+import atexit
+import signal
+import socket
 import hashlib
-from os.path import basename, splitext
+import weakref
+from multiprocessing import cpu_count
+from threading import Lock, RLock, Event
+from functools import partial
+from os.path import basename, splitext, join, abspath, dirname, exists
+from os.path import relpath, realpath, isabs, normpath, isdir
+from shutil import copyfile, rmtree
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 import manuallabour.core.common as common
-from manuallabour.core.common import calculate_blob_checksum
+
+#extensions of mesh formats that can be converted from the geometry
+MESH_FORMATS = ['.stl','.off','.amf','.3mf']
+
+#keys of the yaml items that influence the render
+RENDER_KEYS = ['scadfile','module','parameters','size','camera']
+
+#statements that refer to other files
+USE_RE = re.compile(r'\b(?:use|include)\s*<([^>]+)>')
+IMPORT_RE = re.compile(r'\b(?:import|surface)\s*\(\s*(?:file\s*=\s*)?"([^"]+)"')
+
+def scan_files(path,basedir,found=None):
+    """
+    returns a list with the scadfile at path and all files it uses,
+    includes or imports, imports are relative to basedir if they are not
+    found next to the file. Files that can not be found are skipped, they
+    are assumed to be in the library path.
+    """
+    if found is None:
+        found = []
+    if path in found or not exists(path):
+        return found
+    found.append(path)
+    if splitext(path)[1] != '.scad':
+        return found
+    source = open(path).read()
+    for name in USE_RE.findall(source):
+        scan_files(normpath(join(dirname(path),name)),basedir,found)
+    for name in IMPORT_RE.findall(source):
+        if not exists(join(dirname(path),name)):
+            name = join(basedir,name)
+        scan_files(normpath(join(dirname(path),name)),basedir,found)
+    return found
+
+def scratch_dir(parent=None):
+    """
+    returns the directory for temporary files, which is parent if given,
+    otherwise tmpfs if available
+    """
+    if parent is not None:
+        return parent
+    if isdir('/dev/shm') and os.access('/dev/shm',os.W_OK):
+        return '/dev/shm'
+    return gettempdir()
+
+def _host_prefix(prefix):
+    """
+    returns the prefix for the temporary directories of processes on this
+    host, the parent directory might be shared with other hosts
+    """
+    return '%s%s-' % (prefix,socket.gethostname().replace('-','_'))
+
+def _process_prefix(prefix):
+    """
+    returns the prefix for the temporary directories of this process
+    """
+    return '%s%d-' % (_host_prefix(prefix),os.getpid())
+
+def remove_stale(parent,prefix):
+    """
+    remove the temporary directories in parent that were created with
+    _process_prefix(prefix) by processes on this host that no longer run
+    """
+    local = _host_prefix(prefix)
+    for name in os.listdir(parent):
+        if not name.startswith(local):
+            continue
+        try:
+            pid = int(name[len(local):].split('-')[0])
+            os.kill(pid,0)
+        except ValueError:
+            continue
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                rmtree(join(parent,name),True)
+
+class Scratch:
+    """
+    Directory for the temporary files of the renders of one process, so
+    that they do not end up in the project. It is created on first use
+    and removed when the process exits. Directories left behind by
+    processes on this host that were killed are removed as well.
+    """
+    prefix = 'manufac-scratch-'
+
+    def __init__(self,parent=None):
+        self.parent = scratch_dir(parent)
+        self.path = None
+        self.lock = Lock()
+        self.registered = False
+
+    def _dir(self):
+        with self.lock:
+            if self.path is None:
+                remove_stale(self.parent,self.prefix)
+                self.path = realpath(mkdtemp(
+                    prefix=_process_prefix(self.prefix),
+                    dir=self.parent
+                ))
+                if not self.registered:
+                    atexit.register(self.close)
+                    self.registered = True
+            return self.path
+
+    def close(self):
+        with self.lock:
+            if self.path is not None:
+                rmtree(self.path,True)
+                self.path = None
+
+    def contains(self,path):
+        return self.path is not None and \
+            realpath(path).startswith(self.path + os.sep)
+
+    def wrapper(self,source):
+        """
+        returns the path of a scadfile with the contents source, identical
+        sources share the same file
+        """
+        path = join(
+            self._dir(),
+            hashlib.sha1(source).hexdigest() + '.scad'
+        )
+        if not exists(path):
+            fd, tmp_path = mkstemp(suffix=".tmp",dir=self._dir())
+            with os.fdopen(fd,'w') as fid:
+                fid.write(source)
+            os.rename(tmp_path,path)
+        return path
+
+    def tempfile(self,suffix):
+        """
+        returns the path of a new empty file, which has to be removed by
+        the caller
+        """
+        fd, path = mkstemp(suffix=suffix,dir=self._dir())
+        os.close(fd)
+        return path
+
+def _kill(proc):
+    """
+    kill a process started by OpenSCADRenderer and its children
+    """
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid,signal.SIGKILL)
+        else:
+            proc.kill()
+    except OSError:
+        #already finished
+        pass
+
+#renderers that are cancelled on SIGTERM
+_renderers = weakref.WeakSet()
+
+def _terminate(signum,frame):
+    """
+    SIGTERM handler, stops the renders, which run in their own process
+    groups and would otherwise outlive manufac, and exits
+    """
+    for renderer in list(_renderers):
+        renderer.cancel()
+    raise SystemExit(128 + signum)
+
+def cancel_on_sigterm():
+    """
+    cancel the renders of all OpenSCADRenderers when the process receives
+    SIGTERM, unless it handles SIGTERM already. To be called by
+    applications from the main thread.
+    """
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM,_terminate)
+
+class Renderer:
+    """
+    Base class for renderers. A render is stopped after timeout seconds
+    and may use at most memory bytes, which can also be given as string
+    like 4G. Renders can be cancelled from other threads.
+    """
+    def __init__(self,timeout=None,memory=None):
+        self.timeout = None if timeout is None else float(timeout)
+        if isinstance(memory,basestring):
+            memory = parse_size(memory)
+        self.memory = memory
+        #reentrant, as cancel can be called from a signal handler
+        self.lock = RLock()
+        self.cancelled = Event()
+        self.processes = set([])
+
+    def reset(self):
+        """
+        allow renders again after cancel
+        """
+        self.cancelled.clear()
+
+    def cancel(self):
+        """
+        stop all running renders and make them and all further renders
+        raise Cancelled
+        """
+        with self.lock:
+            self.cancelled.set()
+            for proc in self.processes:
+                _kill(proc)
+
+    def _check(self):
+        if self.cancelled.is_set():
+            raise Cancelled("Render cancelled")
+
+    def _timeout(self):
+        return False, "timed out after %g s" % self.timeout
+
+class OpenSCADRenderer(Renderer):
+    """
+    Renders by running the OpenSCAD executable. The renders are
+    cancelled on SIGTERM, if the application calls cancel_on_sigterm. If
+    manufac is killed, a limit on the CPU time derived from the timeout
+    stops them eventually.
+    """
+    def __init__(self,executable='openscad',**kwargs):
+        Renderer.__init__(self,**kwargs)
+        self.executable = executable
+        self.cpu_time = None
+        if self.timeout is not None:
+            #OpenSCAD can use all cores, so this never hits before the
+            #timeout
+            self.cpu_time = int(self.timeout*cpu_count()) + 1
+        _renderers.add(self)
+
+    def _limits(self):
+        #run in the child process before OpenSCAD is started. The child
+        #gets its own process group, so that Ctrl-C reaches only manufac,
+        #which then cancels the renders.
+        os.setpgrp()
+        if resource is None:
+            return
+        if self.memory is not None:
+            resource.setrlimit(resource.RLIMIT_AS,(self.memory,self.memory))
+        if self.cpu_time is not None:
+            resource.setrlimit(
+                resource.RLIMIT_CPU,
+                (self.cpu_time,self.cpu_time + 1)
+            )
+
+    def run(self,target,options,source,dep_path):
+        """
+        render the scadfile source to target, passing a list of additional
+        options, and write a make style list of dependencies to dep_path.
+        returns a tuple of a success flag and the error output
+        """
+        args = [self.executable,"-o",target,"-d",dep_path] + options + [source]
+        #a file instead of a pipe, that could fill up while polling
+        err = TemporaryFile(dir=dirname(dep_path))
+        try:
+            return self._wait(self._start(args,err),err)
+        finally:
+            err.close()
+
+    def _start(self,args,err):
+        kwargs = {}
+        if os.name == 'posix':
+            kwargs['preexec_fn'] = self._limits
+        with self.lock:
+            self._check()
+            proc = Popen(
+                args,
+                stdout=open(os.devnull,'w'),
+                stderr=err,
+                **kwargs
+            )
+            self.processes.add(proc)
+        return proc
+
+    def _wait(self,proc,err):
+        start = time()
+        interval = 0.001
+        try:
+            while proc.poll() is None:
+                if self.timeout is not None and time() - start > self.timeout:
+                    _kill(proc)
+                    proc.wait()
+                    return self._timeout()
+                sleep(interval)
+                interval = min(2*interval,0.05)
+        except BaseException:
+            _kill(proc)
+            proc.wait()
+            raise
+        finally:
+            with self.lock:
+                self.processes.discard(proc)
+
+        if proc.returncode != 0:
+            self._check()
+        err.seek(0)
+        return proc.returncode == 0, err.read().strip()
+
+class FakeRenderer(Renderer):
+    """
+    Renderer that does not run OpenSCAD, for benchmarks and tests on
+    machines without it. It takes latency seconds plus up to jitter seconds
+    to write size bytes, and reports the source and the files it uses,
+    includes or imports as dependencies. A fraction failure_rate of the
+    renders fail. Everything is derived from the contents of the source
+    and the options, so repeated renders give the same results.
+    """
+    def __init__(self,latency=0.,jitter=0.,size=1024,failure_rate=0.,
+            **kwargs):
+        Renderer.__init__(self,**kwargs)
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.size = int(size)
+        self.failure_rate = float(failure_rate)
+
+    def run(self,target,options,source,dep_path):
+        self._check()
+        deps = scan_files(source,dirname(source))
+
+        key = hashlib.sha1(repr(options))
+        for dep in deps:
+            key.update(open(dep,'rb').read())
+        rng = Random(int(key.hexdigest(),16))
+
+        delay = self.latency + self.jitter*rng.random()
+        if self.timeout is not None and delay > self.timeout:
+            self.cancelled.wait(self.timeout)
+            self._check()
+            return self._timeout()
+        self.cancelled.wait(delay)
+        self._check()
+
+        with open(dep_path,'w') as fid:
+            fid.write("%s: \\\n" % target)
+            fid.write("".join("\t%s \\\n" % dep for dep in deps))
+        if rng.random() < self.failure_rate:
+            return False, "Synthetic failure"
+
+        with open(target,'wb') as fid:
+            block = key.digest()
+            fid.write((block*(self.size/len(block) + 1))[:self.size])
+        return True, ""
+
+#available renderers by name
+RENDERERS = {'openscad' : OpenSCADRenderer, 'fake' : FakeRenderer}
+
+def get_renderer(spec,**kwargs):
+    """
+    create a renderer from a string of the form name[:key=value,...],
+    e.g. fake:latency=0.5,size=2048. Keyword arguments are defaults for
+    the options.
+    """
+    name, _, args = spec.partition(':')
+    if not name in RENDERERS:
+        raise ValueError("Unknown renderer: %s" % name)
+    for arg in args.split(','):
+        if arg:
+            key, _, value = arg.partition('=')
+            kwargs[key.strip()] = value.strip()
+    return RENDERERS[name](**kwargs)
 
 class OpenSCADImporter(ImporterBase):
-    def __init__(self,basedir):
+    """
+    Importer for images, files and objects rendered with OpenSCAD.
+
+    If geometry is True, the geometry of each scadfile, module and
+    parameters is evaluated only once and exported as mesh. Images and
+    mesh files are then derived from this mesh, which is much faster for
+    complex geometry, but loses colors.
+
+    If queue is the path of a directory, the renders are not run locally,
+    but sent to the worker processes serving this directory, see
+    run_worker. Each render waits for its job, so the FileCache should
+    run all renders at once, with jobs=None.
+
+    renderer is a string describing the renderer, see get_renderer. Each
+    render is stopped after timeout seconds and may use memory bytes.
+    Temporary files are created in a Scratch directory in scratch.
+    """
+    def __init__(self,basedir,geometry=False,queue=None,renderer='openscad',
+            scratch=None,timeout=None,memory=None):
         ImporterBase.__init__(self,'openscad')
         self.basedir = basedir
+        self.geometry = geometry
+        self.queue = None if queue is None else JobQueue(queue)
+        self.renderer = get_renderer(renderer,timeout=timeout,memory=memory)
+        self.scratch = Scratch(scratch)
 
-    def _extract_dependencies(self,dep_path,tmps):
+    def _extract_dependencies(self,dep_path):
         lines = open(dep_path).readlines()
         deps = []
         lines.pop(0)
         for line in lines:
             dep = line.strip(" \n\t\\")
-            if not dep in tmps:
+            if not self.scratch.contains(dep):
                 deps.append(dep)
         return deps
 
-    def _image(self,target,**kwargs):
-        args = ["openscad","-o",target]
-
-        #dependencies
-        dep_fd, dep_path = mkstemp(suffix=".deps",dir=self.basedir)
-        args.append("-d")
-        args.append(dep_path)
-
-        if "size" in kwargs:
-            args.append('--imgsize=%d,%d' % tuple(kwargs["size"]))
-        if "camera" in kwargs:
-            args.append('--camer=%d,%d,%d,0,0,0' % tuple(kwargs["camera"]))
-
-        if "module" in kwargs:
-            fd, tpath = mkstemp(suffix=".scad",dir=self.basedir)
-            fid = os.fdopen(fd,'w')
-            fid.write("use <%s>\n" % kwargs["scadfile"])
+    def _render(self,target,options,**kwargs):
+        """
+        render the scadfile or module call described by kwargs to target,
+        returns the list of dependencies
+        """
+        if self.queue is not None:
+            return self._remote(target,options,kwargs)
+
+        if "geometry_path" in kwargs:
+            source = self.scratch.wrapper(
+                'import("%s");\n' % abspath(kwargs["geometry_path"])
+            )
+        elif "module" in kwargs:
+            call = "use <%s>\n" % abspath(join(self.basedir,kwargs["scadfile"]))
             if "parameters" in kwargs:
-                fid.write("%s(%s);\n" % (kwargs["module"],",".join([str(p) for p in kwargs["parameters"]])))
+                call += "%s(%s);\n" % (kwargs["module"],",".join([str(p) for p in kwargs["parameters"]]))
             else:
-                fid.write("%s();\n" % kwargs["module"])
-
-            fid.close()
-
-            args.append(tpath)
-            call(args,stdout=open(os.devnull,'w'),stderr=open(os.devnull,'w'))
-            os.remove(tpath)
+                call += "%s();\n" % kwargs["module"]
+            source = self.scratch.wrapper(call)
         else:
-            args.append(join(self.basedir,kwargs["scadfile"]))
-            call(args,stdout=open(os.devnull,'w'),stderr=open(os.devnull,'w'))
-
-        #extract dependencies
-        deps = self._extract_dependencies(dep_path,tpath)
-        os.remove(dep_path)
-        return deps
-
-    def _file(self,target,**kwargs):
-        args = ["openscad","-o",target]
-
-        #dependencies
-        dep_fd, dep_path = mkstemp(suffix=".deps",dir=self.basedir)
-        args.append("-d")
-        args.append(dep_path)
-
-        if "module" in kwargs:
-            fd, tpath = mkstemp(suffix=".scad",dir=self.basedir)
-            fid = os.fdopen(fd,'w')
-            fid.write("use <%s>\n" % kwargs["scadfile"])
-            if "parameters" in kwargs:
-                fid.write("%s(%s);\n" % (kwargs["module"],",".join([str(p) for p in kwargs["parameters"]])))
+            source = join(self.basedir,kwargs["scadfile"])
+
+        dep_path = self.scratch.tempfile(".deps")
+        try:
+            success, err = self.renderer.run(target,options,source,dep_path)
+
+            #extract dependencies
+            deps = []
+            if os.path.getsize(dep_path) > 0:
+                deps = self._extract_dependencies(dep_path)
+            elif not success:
+                #e.g. after a timeout, use the files that are referenced
+                deps = [dep for dep in scan_files(source,self.basedir)
+                    if not self.scratch.contains(dep)]
+        finally:
+            os.remove(dep_path)
+
+        if not success or not os.path.exists(target):
+            if "module" in kwargs:
+                call = "%s(%s) from %s" % (
+                    kwargs["module"],
+                    ",".join([str(p) for p in kwargs.get("parameters",[])]),
+                    kwargs["scadfile"]
+                )
             else:
-                fid.write("%s();\n" % kwargs["module"])
+                call = kwargs["scadfile"]
+            raise RenderError(
+                "OpenSCAD failed to render %s: %s" % (call,err),
+                deps
+            )
+        return deps
 
-            fid.close()
+    def _remote(self,target,options,kwargs):
+        """
+        render on a worker, by sending the request together with the
+        files it needs
+        """
+        basedir = abspath(self.basedir)
+        files = scan_files(join(basedir,kwargs["scadfile"]),basedir)
+        kwargs = dict(kwargs)
+        if "geometry_path" in kwargs:
+            files.append(abspath(kwargs["geometry_path"]))
+
+        #paths are sent relative to the common directory of all files
+        root = os.sep.join(os.path.commonprefix(
+            [dirname(f).split(os.sep) for f in files] + [basedir.split(os.sep)]
+        )) or os.sep
+        if "geometry_path" in kwargs:
+            kwargs["geometry_path"] = relpath(kwargs["geometry_path"],root)
+
+        self.renderer._check()
+        job_id = self.queue.submit(dict(
+            options=options,
+            kwargs=kwargs,
+            basedir=relpath(basedir,root),
+            extension=splitext(target)[1],
+            files=dict((relpath(f,root),self.queue.put_blob(f)) for f in files)
+        ))
+        result = self.queue.collect(
+            job_id,
+            target,
+            cancelled=self.renderer.cancelled,
+            timeout=self.renderer.timeout
+        )
+
+        deps = [join(root,dep) for dep in result["deps"]]
+        if "error" in result:
+            raise RenderError(result["error"],deps)
+        return deps
 
-            args.append(tpath)
-            call(args,stdout=open(os.devnull,'w'),stderr=open(os.devnull,'w'))
-            os.remove(tpath)
-        else:
-            args.append(join(self.basedir,kwargs["scadfile"]))
-            call(args,stdout=open(os.devnull,'w'),stderr=open(os.devnull,'w'))
+    def _image(self,target,**kwargs):
+        options = []
+        if "size" in kwargs:
+            options.append('--imgsize=%d,%d' % tuple(kwargs["size"]))
+        if "camera" in kwargs:
+            options.append('--camer=%d,%d,%d,0,0,0' % tuple(kwargs["camera"]))
 
-        #extract dependencies
-        deps = self._extract_dependencies(dep_path,tpath)
-        os.remove(dep_path)
-        return deps
+        return self._render(target,options,**kwargs)
 
-    def process(self,scaf):
-        for alias, step_dict in scaf.steps_raw.iteritems():
-            out = scaf.steps_out[alias]
+    def _file(self,target,**kwargs):
+        return self._render(target,[],**kwargs)
+
+    def _copy(self,target,**kwargs):
+        copyfile(kwargs["geometry_path"],target)
+        return [kwargs["geometry_path"]]
+
+    def _geometry_jobs(self,jobs):
+        """
+        returns the jobs that evaluate the geometry for all jobs that can
+        be derived from it, and the indices of these jobs
+        """
+        geometry_jobs = []
+        indices = []
+        for i, (callback,kwargs) in enumerate(jobs):
+            if callback == self._file and \
+                    not kwargs["extension"] in MESH_FORMATS:
+                continue
+            geometry = dict(
+                importer='openscad',
+                extension='.stl',
+                stage='geometry'
+            )
+            for key in ["scadfile","module","parameters"]:
+                if key in kwargs:
+                    geometry[key] = kwargs[key]
+            geometry_jobs.append((self._file,geometry))
+            indices.append(i)
+        return geometry_jobs, indices
+
+    def _derive(self,job,geometry_id,path):
+        """
+        returns a job that derives the result of job from the geometry with
+        target id geometry_id at path. The target only depends on the id,
+        the path is passed to the callback.
+        """
+        callback, kwargs = job
+        kwargs = dict(geometry=geometry_id,**kwargs)
+        if callback == self._file and kwargs["extension"] == '.stl':
+            callback = self._copy
+        return (partial(callback,geometry_path=path),kwargs)
+
+    def _with_geometry(self,cache,jobs):
+        """
+        evaluate the geometry for all jobs that can be derived from it, and
+        return the modified jobs together with the dependencies of the
+        geometry
+        """
+        geometry_jobs, indices = self._geometry_jobs(jobs)
+
+        jobs = list(jobs)
+        sources = [None]*len(jobs)
+        results = self._batch(cache,geometry_jobs)
+        for i, (callback,kwargs), (path,deps) in \
+                zip(indices,geometry_jobs,results):
+            jobs[i] = self._derive(jobs[i],cache.target_id(kwargs),path)
+            sources[i] = deps
+        return jobs, sources
+
+    def _batch(self,cache,jobs):
+        """
+        create the files for a list of jobs, cancelling the renders when
+        the cache requests it. Jobs that were already processed in this
+        build, i.e. in the current context of the cache, are not passed to
+        the cache again.
+        """
+        done = cache.memo.setdefault('openscad',{})
+        ids = [cache.target_id(kwargs) for callback, kwargs in jobs]
+        todo = [(job,target_id) for job, target_id in zip(jobs,ids)
+            if not target_id in done]
+        if todo:
+            cache.on_cancel(self.renderer.cancel)
+            self.renderer.reset()
+            results = cache.process_many([job for job, target_id in todo])
+            for (job,target_id), result in zip(todo,results):
+                done[target_id] = result
+        return [done[target_id] for target_id in ids]
+
+    def _sourcefiles(self,scaf,deps):
+        sourcefiles = []
+        if not deps is None:
+            for dep in deps:
+                sourcefiles.append(dict(
+                    blob_id=add_blob(scaf.store,dep,scaf.cache),
+                    filename=basename(dep)
+                ))
+        return sourcefiles
+
+    def _request(self,extension,item):
+        """
+        returns the canonical keyword arguments for rendering the yaml
+        item, so that equal renders get the same target
+        """
+        kwargs = dict(importer='openscad',extension=extension)
+        for key in RENDER_KEYS:
+            if key in item:
+                kwargs[key] = list(item[key]) \
+                    if isinstance(item[key],(list,tuple)) else item[key]
+        if "parameters" in kwargs:
+            kwargs["parameters"] = [str(p) for p in kwargs["parameters"]]
+            if not kwargs["parameters"]:
+                del kwargs["parameters"]
+        return kwargs
+
+    def _jobs(self,steps_raw):
+        """
+        collect the render jobs for the steps. Returns a list of
+        (callback, kwargs) tuples and a list of (alias, obj_type, id, data)
+        tuples describing where the results belong.
+        """
+        jobs = []
+        targets = []
+        for alias, step_dict in steps_raw.iteritems():
             if not 'openscad' in step_dict:
                 continue
             openscad = step_dict["openscad"]
 
             if "images" in openscad:
                 for id,item in openscad["images"].iteritems():
-                    path,deps = scaf.cache.process(
-                        self._image,
-                        importer='openscad',
-                        extension='.png',
-                        **item)
-                    with open(path,'rb') as fid:
-                        blob_id = calculate_blob_checksum(fid)
-                    if not scaf.store.has_blob(blob_id):
-                        scaf.store.add_blob(blob_id,path)
-
-                    img_dict = dict(
-                        blob_id=blob_id,
-                        extension='.png',
-                        alt='Render of %s' % item['scadfile'],
-                        sourcefiles=[]
-                    )
-                    if not deps is None:
-                        for dep in deps:
-                            with open(dep,'rb') as fid:
-                                dep_id = calculate_blob_checksum(fid)
-                            if not scaf.store.has_blob(dep_id):
-                                scaf.store.add_blob(dep_id,dep)
-                            img_dict["sourcefiles"].append(dict(
-                                blob_id=dep_id,
-                                filename=basename(dep)
-                            ))
-
-                    out['images'][id] = img_dict
+                    jobs.append((self._image,self._request('.png',item)))
+                    targets.append((alias,"images",id,item))
 
             if "files" in openscad:
                 for id,item in openscad["files"].iteritems():
-                    path,deps = scaf.cache.process(
-                        self._file,
-                        importer='openscad',
-                        extension=splitext(item['filename'])[1],
-                        **item)
-                    with open(path,'rb') as fid:
-                        blob_id = calculate_blob_checksum(fid)
-                    if not scaf.store.has_blob(blob_id):
-                        scaf.store.add_blob(blob_id,path)
-
-                    file_dict = dict(
-                        blob_id=blob_id,
-                        filename=item['filename'],
-                        sourcefiles=[]
-                    )
-                    if not deps is None:
-                        for dep in deps:
-                            with open(dep,'rb') as fid:
-                                dep_id = calculate_blob_checksum(fid)
-                            if not scaf.store.has_blob(dep_id):
-                                scaf.store.add_blob(dep_id,dep)
-                            file_dict["sourcefiles"].append(dict(
-                                blob_id=dep_id,
-                                filename=basename(dep)
-                            ))
-
-                    out['files'][id] = file_dict
+                    extension = splitext(item['filename'])[1]
+                    jobs.append((self._file,self._request(extension,item)))
+                    targets.append((alias,"files",id,item))
 
             for obj_type in ["parts","tools","results"]:
                 if obj_type in openscad:
                     for id,item in openscad[obj_type].iteritems():
                         obj_dict = {}
-                        obj_dict["name"] = item.pop('name')
+                        obj_dict["name"] = item['name']
                         if "description" in item:
-                            obj_dict["description"] = item.pop('description')
-
-                        quantity = item.pop('quantity',1)
-                        optional = item.pop('optional',False)
-
-                        #create image
-                        path, deps = scaf.cache.process(
-                            self._image,
-                            importer='openscad',
-                            extension='.png',
-                            **item)
-                        with open(path,'rb') as fid:
-                            blob_id = calculate_blob_checksum(fid)
-                        if not scaf.store.has_blob(blob_id):
-                            scaf.store.add_blob(blob_id,path)
-
-                        img_dict = dict(
-                            blob_id=blob_id,
-                            extension='.png',
-                            alt="Render of %s" % obj_dict["name"],
-                            sourcefiles=[]
-                        )
-                        if not deps is None:
-                            for dep in deps:
-                                with open(dep,'rb') as fid:
-                                    dep_id = calculate_blob_checksum(fid)
-                                if not scaf.store.has_blob(dep_id):
-                                    scaf.store.add_blob(dep_id,dep)
-                                img_dict["sourcefiles"].append(dict(
-                                    blob_id=dep_id,
-                                    filename=basename(dep)
-                                ))
-
-                        obj_dict["images"] = [img_dict]
-
-                        obj_id = common.Object.calculate_checksum(**obj_dict)
-
-                        if not scaf.store.has_obj(obj_id):
-                            scaf.store.add_obj(common.Object(
-                                obj_id=obj_id,
-                                **obj_dict
-                            ))
-
-                        if obj_type == "results":
-                            out[obj_type][id] = dict(
-                                obj_id=obj_id,
-                                created=True,
-                                quantity=quantity
-                            )
-                        else:
-                            out[obj_type][id] = dict(
-                                obj_id=obj_id,
-                                optional=optional,
-                                quantity=quantity
-                            )
+                            obj_dict["description"] = item['description']
+
+                        quantity = item.get('quantity',1)
+                        optional = item.get('optional',False)
+
+                        jobs.append((self._image,self._request('.png',item)))
+                        targets.append((
+                            alias,
+                            obj_type,
+                            id,
+                            (obj_dict,quantity,optional)
+                        ))
+        return jobs, targets
+
+    def prepare(self,cache,documents):
+        #render the jobs of all documents in one batch, process reuses the
+        #results
+        jobs = []
+        for filename, inst in documents:
+            jobs += self._jobs(inst["steps"])[0]
+        if self.geometry:
+            jobs = self._with_geometry(cache,jobs)[0]
+        self._batch(cache,jobs)
+
+    def plan(self,cache,documents):
+        jobs = []
+        for filename, inst in documents:
+            jobs += self._jobs(inst["steps"])[0]
+        if not self.geometry:
+            return cache.status(jobs)
+
+        #the views can only be derived once the geometry exists
+        geometry_jobs, indices = self._geometry_jobs(jobs)
+        res = cache.status(geometry_jobs)
+        jobs = list(jobs)
+        stale = set()
+        for i, status in zip(indices,res):
+            jobs[i] = self._derive(jobs[i],status["target"],status["path"])
+            if status["state"] != 'fresh':
+                stale.add(i)
+        for i, status in enumerate(cache.status(jobs)):
+            if i in stale and status["state"] == 'fresh':
+                status["state"] = 'stale'
+                status["reason"] = 'geometry'
+            res.append(status)
+        return res
+
+    def process(self,scaf):
+        #collect render jobs, the results are added in the same order
+        jobs, targets = self._jobs(scaf.steps_raw)
+
+        sources = [None]*len(jobs)
+        if self.geometry:
+            jobs, sources = self._with_geometry(scaf.cache,jobs)
+
+        results = self._batch(scaf.cache,jobs)
+
+        #hash the outputs and sources in parallel
+        paths = []
+        for path, deps in results:
+            paths.append(path)
+            paths += deps or []
+        for deps in sources:
+            paths += deps or []
+        blob_index(scaf.cache).prefetch(paths)
+
+        for (alias,obj_type,id,item), (path,deps), source_deps in \
+                zip(targets,results,sources):
+            out = scaf.steps_out[alias]
+            if not source_deps is None:
+                #derived from the geometry, use its dependencies
+                deps = source_deps
+            if obj_type == "images":
+                out['images'][id] = dict(
+                    blob_id=add_blob(scaf.store,path,scaf.cache),
+                    extension='.png',
+                    alt='Render of %s' % item['scadfile'],
+                    sourcefiles=self._sourcefiles(scaf,deps)
+                )
+            elif obj_type == "files":
+                out['files'][id] = dict(
+                    blob_id=add_blob(scaf.store,path,scaf.cache),
+                    filename=item['filename'],
+                    sourcefiles=self._sourcefiles(scaf,deps)
+                )
+            else:
+                obj_dict, quantity, optional = item
+
+                #create image
+                img_dict = dict(
+                    blob_id=add_blob(scaf.store,path,scaf.cache),
+                    extension='.png',
+                    alt="Render of %s" % obj_dict["name"],
+                    sourcefiles=self._sourcefiles(scaf,deps)
+                )
+
+                obj_dict["images"] = [img_dict]
+
+                obj_id = common.Object.calculate_checksum(**obj_dict)
+
+                if not scaf.store.has_obj(obj_id):
+                    scaf.store.add_obj(common.Object(
+                        obj_id=obj_id,
+                        **obj_dict
+                    ))
+
+                if obj_type == "results":
+                    out[obj_type][id] = dict(
+                        obj_id=obj_id,
+                        created=True,
+                        quantity=quantity
+                    )
+                else:
+                    out[obj_type][id] = dict(
+                        obj_id=obj_id,
+                        optional=optional,
+                        quantity=quantity
+                    )
+
+def _check_name(name):
+    """
+    raise ValueError if the path name of a job leads out of the workspace
+    """
+    name = normpath(name)
+    if isabs(name) or name == os.pardir or name.startswith(os.pardir + os.sep):
+        raise ValueError("Invalid path in job: %s" % name)
+
+def run_worker(queue,poll=1.,once=False,renderer='openscad',scratch=None,
+        timeout=None,memory=None):
+    """
+    render the jobs sent to the JobQueue queue by OpenSCADImporters. If
+    once is True, return when there are no more pending jobs, otherwise
+    check for new jobs every poll seconds. Interrupted jobs are put back
+    into the queue. The lease of a job is renewed while it is rendered.
+    """
+    #wrappers contain paths in the workspace, so are not reused across jobs
+    files = Scratch(scratch)
+    remove_stale(scratch_dir(scratch),'manufac-worker-')
+    while True:
+        job = queue.claim()
+        if job is None:
+            if once:
+                return
+            sleep(poll)
+            continue
+        job_id, request = job
+
+        workspace = realpath(mkdtemp(
+            prefix=_process_prefix('manufac-worker-'),
+            dir=scratch_dir(scratch)
+        ))
+        output = None
+        alive = queue.keep_alive(job_id)
+        try:
+            for name, digest in request["files"].iteritems():
+                _check_name(name)
+                queue.get_blob(digest,join(workspace,name))
+
+            kwargs = dict(request["kwargs"])
+            _check_name(request["basedir"])
+            _check_name(join(request["basedir"],kwargs["scadfile"]))
+            if "geometry_path" in kwargs:
+                _check_name(kwargs["geometry_path"])
+                kwargs["geometry_path"] = join(workspace,kwargs["geometry_path"])
+            if not re.match(r'^\.[0-9a-zA-Z]+$',request["extension"]):
+                raise ValueError(
+                    "Invalid extension in job: %s" % request["extension"]
+                )
+            target = join(workspace,'target' + request["extension"])
+
+            imp = OpenSCADImporter(
+                join(workspace,request["basedir"]),
+                renderer=renderer,
+                timeout=timeout,
+                memory=memory
+            )
+            imp.scratch = files
+            try:
+                deps = imp._render(target,request["options"],**kwargs)
+                output = target
+                result = {}
+            except RenderError as e:
+                deps = e.dependencies
+                result = dict(error=str(e))
+
+            #files outside of the workspace are only known to this worker
+            result["deps"] = []
+            for dep in deps:
+                dep = realpath(dep)
+                if dep.startswith(workspace + os.sep):
+                    result["deps"].append(relpath(dep,workspace))
+        except KeyboardInterrupt:
+            alive.set()
+            rmtree(workspace,True)
+            files.close()
+            queue.release(job_id)
+            raise
+        except Exception as e:
+            output = None
+            result = dict(error="Worker failed: %s" % e,deps=[])
+
+        try:
+            queue.finish(job_id,result,output)
+        finally:
+            alive.set()
+            rmtree(workspace,True)
+            files.close()
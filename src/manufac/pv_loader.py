@@ -23,7 +23,8 @@ from pyparsing import Or, CaselessLiteral, OneOrMore, Word, printables, replaceW
 import pyparsing
 from os.path import join,dirname, exists, basename, splitext
 
-from manuallabour.core.common import Object, Step, calculate_blob_checksum
+from manuallabour.core.common import Object, Step
+from manufac.importers.common import add_blob
 from manuallabour.core.graph import Graph
 id_end = []
 
@@ -123,25 +124,23 @@ assignment = Group(assign + number + identifier + Optional(imageref,default=None
 
 verse = verb + subject + preposition + Optional(qualification,default=None) + target + Optional(tooling,default=None) + Optional(illustration,default=None) + Optional(assignment,default=None)
 
-def _image(path,store,alt):
-    with open(path,'rb') as fid:
-        blob_id = calculate_blob_checksum(fid)
-    if not store.has_blob(blob_id):
-        store.add_blob(blob_id,path)
+def _image(path,store,alt,cache):
+    blob_id = add_blob(store,path,cache)
     return dict(
         blob_id=blob_id,
         extension=splitext(path)[1],
         alt=alt
         )
 
-def _object(parsed,store,basedir,created=False):
+def _object(parsed,store,basedir,cache,created=False):
     quantity, name, img = parsed
     obj = dict(name=name)
     if not img is None:
         obj["images"] = [_image(
             join(basedir,img[0]),
             store,
-            "Illustration of %s" % name
+            "Illustration of %s" % name,
+            cache
         )]
 
     obj_id = Object.calculate_checksum(**obj)
@@ -154,7 +153,11 @@ def _object(parsed,store,basedir,created=False):
         created=created
     )
 
-def load_graph(input_file,store,basedir):
+def load_graph(input_file,store,basedir,cache=None):
+    """
+    load the graph from a proces verbal file. If a FileCache is given, it
+    is used to remember the blob ids of the images.
+    """
     steps = []
     results = {}
     for line in open(input_file):
@@ -172,7 +175,7 @@ def load_graph(input_file,store,basedir):
         for subject in subjects:
             if isinstance(subject,pyparsing.ParseResults):
                 #Object description
-                step["parts"]["p%d" % obj_index] = _object(subject,store,basedir)
+                step["parts"]["p%d" % obj_index] = _object(subject,store,basedir,cache)
             else:
                 if subject in pronouns:
                     prev_step = store.get_step(steps[-1]["step_id"])
@@ -190,7 +193,7 @@ def load_graph(input_file,store,basedir):
         #target
         if isinstance(target,pyparsing.ParseResults):
             #Object description
-            step["parts"]["target"] = _object(target,store,basedir)
+            step["parts"]["target"] = _object(target,store,basedir,cache)
         else:
             if target in pronouns:
                 prev_step = store.get_step(steps[-1]["step_id"])
@@ -210,7 +213,7 @@ def load_graph(input_file,store,basedir):
                 if isinstance(tool,pyparsing.ParseResults):
                     #Object description
                 #Object description
-                    step["tools"]["t%d" % obj_index] = _object(tool,store,basedir)
+                    step["tools"]["t%d" % obj_index] = _object(tool,store,basedir,cache)
                 else:
                     if tool in pronouns:
                         prev_step = store.get_step(steps[-1]["step_id"])
@@ -229,13 +232,14 @@ def load_graph(input_file,store,basedir):
             step["images"] = dict(img=_image(
                 join(basedir,image[0]),
                 store,
-                "Illustration of this step"
+                "Illustration of this step",
+                cache
                 )
             )
 
         #result
         if not assign is None:
-            res = _object(assign,store,basedir,created=True)
+            res = _object(assign,store,basedir,cache,created=True)
             step["results"] = dict(result=res)
             results[assign[1]] = res["obj_id"]
 
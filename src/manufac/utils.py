@@ -15,56 +15,1377 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import re
+import sys
+import errno
 import json
 import hashlib
-from os.path import join, exists
-from os import lstat, utime, makedirs
+import mmap
+import marshal
+from time import time, ctime
+from os.path import join, exists, dirname, abspath, relpath, isabs, splitext
+from os.path import isdir, isfile
+from os import lstat, stat, fstat, utime, makedirs, rename, listdir, remove
+from os import getpid, link, rmdir
 from codecs import open
-from shutil import rmtree
+from shutil import rmtree, copy2, move
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError, cpu_count
+from threading import current_thread, Event, Thread
+from functools import partial
+from time import sleep
+from uuid import uuid4
+import yaml
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-class FileCache:
+#the C implementation of the YAML parser is much faster, if available.
+#Only the safe loaders are used, documents must not construct objects
+YAMLLoader = getattr(yaml,'CSafeLoader',yaml.SafeLoader)
+
+SIZE_RE = re.compile("^\s*(\d+)\s*([kKmMgGtT]?)i?[bB]?\s*$")
+SIZE_UNITS = {'' : 0, 'k' : 1, 'm' : 2, 'g' : 3, 't' : 4}
+
+TARGET_RE = re.compile("^[0-9a-f]{128}(\.|$)")
+
+#files larger than this are read through a memory map
+MMAP_SIZE = 1024*1024
+
+def parse_size(size):
+    """
+    parse a string of the form "x[k|M|G|T]" into a number of bytes
+    passes through None
     """
-    Context manager to allow caching
+    if size is None:
+        return None
+    match = SIZE_RE.match(size)
+    if match is None:
+        raise ValueError("Invalid size: %s" % size)
+    return int(match.group(1))*1024**SIZE_UNITS[match.group(2).lower()]
+
+def _makedirs(path):
+    """
+    create a directory and its parents, unless it exists. Safe if other
+    threads or processes create it at the same time.
+    """
+    try:
+        makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not isdir(path):
+            raise
+
+class FileLock:
+    """
+    Context manager holding an exclusive lock on a file, to synchronize
+    processes. It can be entered repeatedly. On platforms without fcntl no
+    locking is done.
     """
     def __init__(self,path):
         self.path = path
-        self.dependencies = None
+        self.fid = None
+        self.depth = 0
+
+    def __enter__(self):
+        if self.depth == 0:
+            if self.fid is None:
+                self.fid = open(self.path,'a')
+            if not fcntl is None:
+                fcntl.flock(self.fid.fileno(),fcntl.LOCK_EX)
+        self.depth += 1
+        return self
+
+    def __exit__(self,exc_type,exc_val,exc_tb):
+        self.depth -= 1
+        if self.depth == 0 and not fcntl is None:
+            fcntl.flock(self.fid.fileno(),fcntl.LOCK_UN)
+        return False
+
+    def close(self):
+        if self.fid is not None:
+            self.fid.close()
+            self.fid = None
+
+class Journal:
+    """
+    Persistent dictionary stored in a file of JSON encoded records, one per
+    line. Every modification appends a single record, so unchanged entries
+    are never rewritten and an interrupted run loses at most the record
+    that was being written. The file is compacted when it consists mostly
+    of superseded records.
+
+    Several processes can use the same journal. Writes are serialized with
+    a lock file, and records appended by other processes are merged by
+    refresh. The file that was read is kept open, so that its inode can
+    not be reused for a file replacing it in a compaction, which would
+    then be mistaken for the file that was read.
+    """
+    def __init__(self,path):
+        self.path = path
+        self.lock = FileLock(path + '.lock')
+        self.data = {}
+        self.records = 0
+        self.offset = 0
+        self.inode = None
+        self.fid = None
+        self.read_fid = None
+        self.load()
+
+    def load(self):
+        """
+        read the records from the file and return the resulting dictionary
+        """
+        self._untrack()
+        self.data.clear()
+        self.records = 0
+        self.offset = 0
+        return self.refresh()
+
+    def _track(self):
+        """
+        start tracking the file that is currently at path
+        """
+        self._untrack()
+        self.read_fid = open(self.path,'rb')
+        self.inode = self._inode(fstat(self.read_fid.fileno()))
+
+    def _untrack(self):
+        if self.read_fid is not None:
+            self.read_fid.close()
+            self.read_fid = None
+        self.inode = None
+
+    def refresh(self):
+        """
+        read the records appended to the file since it was last read, e.g.
+        by other processes, and return the resulting dictionary
+        """
+        try:
+            st = stat(self.path)
+        except OSError:
+            return self.data
+        if self.read_fid is None or self._inode(st) != self.inode or \
+                st.st_size < self.offset:
+            #the file was replaced by a compaction
+            self.data.clear()
+            self.records = 0
+            self.offset = 0
+            self._track()
+        fid = self.read_fid
+        fid.seek(self.offset)
+        for line in fid:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not line.endswith('\n') and not isinstance(record,dict):
+                #incomplete record of an ongoing or interrupted write.
+                #Older versions wrote a single dictionary without newline
+                break
+            self.offset += len(line)
+            if record is None:
+                #terminated record of an interrupted write
+                continue
+            self.records += 1
+            if isinstance(record,dict):
+                #whole dictionary as written by older versions
+                self.data.update(record)
+            elif len(record) == 2:
+                self.data[record[0]] = record[1]
+            else:
+                self.data.pop(record[0],None)
+        return self.data
+
+    def __contains__(self,key):
+        return key in self.data
+
+    def __getitem__(self,key):
+        return self.data[key]
+
+    def get(self,key,default=None):
+        return self.data.get(key,default)
+
+    def set(self,key,value):
+        """
+        set key to value, does nothing if the value is unchanged
+        """
+        if key in self.data and self.data[key] == value:
+            return
+        self.data[key] = value
+        self._append([key,value])
+
+    def delete(self,key):
+        """
+        remove key, does nothing if it does not exist
+        """
+        if not key in self.data:
+            return
+        del self.data[key]
+        self._append([key])
+
+    def _append(self,record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            if self.fid is not None:
+                if not exists(self.path) or self._inode(stat(self.path)) != \
+                        self._inode(fstat(self.fid.fileno())):
+                    #the file was replaced by a compaction
+                    self.fid.close()
+                    self.fid = None
+            if self.fid is None:
+                self.fid = open(self.path,'a+b')
+                #terminate an incomplete record of an interrupted write
+                self.fid.seek(0,2)
+                if self.fid.tell() == 0 and self.read_fid is None:
+                    #newly created file
+                    self._track()
+                elif self.fid.tell() > 0:
+                    self.fid.seek(-1,2)
+                    last = self.fid.read(1)
+                    self.fid.seek(0,2)
+                    if last != '\n':
+                        self.fid.write('\n')
+
+            self.fid.seek(0,2)
+            end = self.fid.tell()
+            self.fid.write(line)
+            self.fid.flush()
+
+            #skip own record when refreshing, unless other records precede it
+            if self.inode == self._inode(fstat(self.fid.fileno())) and \
+                    end == self.offset:
+                self.offset += len(line)
+                self.records += 1
+
+    def _inode(self,st):
+        return (st.st_dev,st.st_ino)
+
+    def compact(self):
+        """
+        rewrite the file with a single record per key, merging the records
+        written by other processes
+        """
+        with self.lock:
+            if self.fid is not None:
+                self.fid.close()
+                self.fid = None
+            self.refresh()
+            tmp_path = '%s.%d.tmp' % (self.path,getpid())
+            with open(tmp_path,'wb') as fid:
+                for key, value in self.data.iteritems():
+                    fid.write(json.dumps([key,value]) + '\n')
+            rename(tmp_path,self.path)
+            self._track()
+            self.offset = fstat(self.read_fid.fileno()).st_size
+            self.records = len(self.data)
+
+    def close(self,compact=True):
+        """
+        close the file, compacting it if necessary and compact is True
+        """
+        if self.fid is not None:
+            self.fid.close()
+            self.fid = None
+        if compact and self.records > 2*len(self.data) + 100:
+            self.compact()
+        self._untrack()
+        self.lock.close()
+
+def file_digest(fid):
+    """
+    returns the hex encoded sha512 digest of the contents of a file object
+    """
+    m = hashlib.sha512()
+    #memory mapped files are hashed without copying
+    read = getattr(fid,'read_buffer',fid.read)
+    while True:
+        chunk = read(1024*1024)
+        if not chunk:
+            break
+        m.update(chunk)
+    return m.hexdigest()
+
+def parse_yaml(path):
+    """
+    returns the first document of a YAML file, or None if it is empty
+    """
+    with open(path,'r','utf8') as fid:
+        return next(yaml.load_all(fid,Loader=YAMLLoader),None)
+
+#parsed documents of this process by absolute path
+_documents = {}
+
+def load_yaml(path,cache=None):
+    """
+    returns the first document of a YAML file. Each file is parsed only
+    once per process, unless it changes, so the document is shared and
+    must not be modified. If a FileCache is given, the document is also
+    stored in it, so that later runs do not parse it again.
+    """
+    path = abspath(path)
+    st = stat(path)
+    key = [st.st_dev,st.st_ino,st.st_size,mtime_ns(st)]
+    if path in _documents and _documents[path][0] == key:
+        return _documents[path][1]
+    if cache is None:
+        inst = parse_yaml(path)
+    else:
+        inst = cache.parsed(path,parse_yaml)
+    _documents[path] = (key,inst)
+    return inst
+
+def mtime_ns(st):
+    """
+    returns the modification time of a stat result in nanoseconds
+    """
+    if hasattr(st,'st_mtime_ns'):
+        return st.st_mtime_ns
+    return int(st.st_mtime*1e9)
+
+class MappedFile:
+    """
+    Read only file object for a file that is mapped into memory, to avoid
+    copying its contents through the buffers of a regular file
+    """
+    def __init__(self,path):
+        with open(path,'rb') as fid:
+            self.map = mmap.mmap(fid.fileno(),0,access=mmap.ACCESS_READ)
+        self.pos = 0
+
     def __enter__(self):
-        #load cached dependency data
-        dep_path = join(self.path,'.deps')
-        if not exists(dep_path):
-            self.dependencies = {}
+        return self
+
+    def __exit__(self,exc_type,exc_val,exc_tb):
+        self.close()
+        return False
+
+    def read(self,size=-1):
+        return str(self.read_buffer(size))
+
+    def read_buffer(self,size=-1):
+        """
+        like read, but returns a buffer referring to the mapped memory
+        instead of a copy. It must not be used after close.
+        """
+        if size < 0:
+            size = len(self.map) - self.pos
+        data = buffer(self.map,self.pos,size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.map.close()
+
+def open_blob(path):
+    """
+    open a file for reading, large files are memory mapped
+    """
+    if stat(path).st_size >= MMAP_SIZE:
+        return MappedFile(path)
+    return open(path,'rb')
+
+#files modified less than this many seconds before they are hashed are
+#not indexed, as they could be modified again without changing size and
+#modification time, whose resolution may be as coarse as this
+RACY_WINDOW = 2.
+
+class DigestIndex:
+    """
+    Memo of file digests stored in a journal. Entries are keyed by device
+    and inode and are only valid as long as size and modification time of
+    the file are unchanged, so files are hashed again only if they might
+    have been modified. The path is stored as well, so that entries of
+    files that were removed or replaced can be pruned. If read_only is
+    True, new digests are not stored. Neither are the digests of files
+    that were modified just before they were hashed.
+
+    Digests of files that will be needed later can be calculated in
+    advance on a pool of jobs threads with prefetch. The digest functions
+    release the interpreter lock while hashing, so this runs in parallel
+    with the main thread.
+    """
+    def __init__(self,journal,digest=file_digest,jobs=None,read_only=False):
+        self.journal = journal
+        self.digest_func = digest
+        self.read_only = read_only
+        self.jobs = jobs or cpu_count()
+        self.pool = None
+        self.pending = {}
+
+    def _key(self,st):
+        return "%d:%d" % (st.st_dev,st.st_ino)
+
+    def _entry(self,st):
+        return [st.st_size,mtime_ns(st)]
+
+    def _calculate(self,path):
+        with open_blob(path) as fid:
+            return self.digest_func(fid)
+
+    def prefetch(self,paths):
+        """
+        start calculating the digests of the files in the background
+        """
+        for path in paths:
+            path = abspath(path)
+            if path in self.pending or not exists(path):
+                continue
+            st = stat(path)
+            entry = self.journal.get(self._key(st))
+            if entry is not None and entry[:2] == self._entry(st):
+                continue
+            if self.pool is None:
+                self.pool = ThreadPool(self.jobs)
+            result = self.pool.apply_async(self._calculate,(path,))
+            self.pending[path] = (st,time(),result)
+
+    def digest(self,path):
+        """
+        returns the digest of the file at path
+        """
+        st = stat(path)
+        key = self._key(st)
+        entry = self.journal.get(key)
+        if entry is not None and entry[:2] == self._entry(st):
+            return entry[2]
+
+        digest = None
+        checked = time()
+        pending = self.pending.pop(abspath(path),None)
+        if pending is not None and self._key(pending[0]) == key and \
+                self._entry(pending[0]) == self._entry(st):
+            try:
+                digest = pending[2].get()
+                checked = pending[1]
+            except (IOError,OSError):
+                #retry in this thread
+                pass
+        if digest is None:
+            digest = self._calculate(path)
+        self._store(st,checked,digest,abspath(path))
+        return digest
+
+    def _store(self,st,checked,digest,path):
+        #checked is the time before the file was hashed
+        if self.read_only or checked - st.st_mtime < RACY_WINDOW:
+            return
+        self.journal.set(self._key(st),self._entry(st) + [digest,path])
+
+    def prune(self):
+        """
+        remove the entries of files that no longer exist under their path,
+        returns the number of removed entries
+        """
+        dead = []
+        for key, entry in self.journal.data.iteritems():
+            try:
+                if len(entry) > 3 and self._key(stat(entry[3])) == key:
+                    continue
+            except OSError:
+                pass
+            dead.append(key)
+        for key in dead:
+            self.journal.delete(key)
+        return len(dead)
+
+    def close(self):
+        """
+        store the prefetched digests that are finished and stop the threads
+        """
+        for path, (st,checked,result) in self.pending.iteritems():
+            if result.ready() and result.successful():
+                self._store(st,checked,result.get(),path)
+        self.pending = {}
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+#the last use of targets is recorded in a journal with this resolution in
+#seconds, so that unchanged builds rarely write. Access times are not used,
+#as setting them without changing the modification time is not exact.
+USE_RESOLUTION = 3600.
+
+def _record_use(journal,key):
+    """
+    record in journal that key was used now
+    """
+    now = time()
+    if now - journal.get(key,0) > USE_RESOLUTION:
+        journal.set(key,int(now))
+
+class SharedCache:
+    """
+    Content addressed store for targets, shared between the caches of
+    several projects on one machine. Targets are stored under the digest of
+    their contents and indexed by the target id together with the paths
+    and digests of their dependencies. They are linked into the project
+    caches, so each distinct target is created only once. Its size is
+    limited with gc.
+    """
+    #number of dependency variants remembered per target id
+    max_variants = 8
+
+    def __init__(self,path):
+        self.path = path
+        self.index = None
+        self.used = None
+
+    def _index(self):
+        if self.index is None:
+            if not exists(self.path):
+                makedirs(self.path)
+            self.index = Journal(join(self.path,'index'))
+        return self.index
+
+    def _used(self):
+        if self.used is None:
+            self._index()
+            self.used = Journal(join(self.path,'used'))
+        return self.used
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        if self.used is not None:
+            self.used.close()
+            self.used = None
+
+    def use(self,name):
+        """
+        mark a stored object as used for the least recently used eviction
+        """
+        if exists(join(self.path,'objects',name)):
+            _record_use(self._used(),name)
+
+    def variants(self,target_id):
+        """
+        returns a list of dictionaries for the stored variants of a target,
+        with the object name and a list of dependency paths and digests.
+        Variants whose objects were evicted are skipped.
+        """
+        if not exists(self.path):
+            return []
+        return [v for v in self._index().refresh().get(target_id,[])
+            if exists(join(self.path,'objects',v["object"]))]
+
+    def publish(self,target_id,target_path,deps):
+        """
+        store a target with a list of [path, digest] pairs of its
+        dependencies
+        """
+        with open(target_path,'rb') as fid:
+            digest = file_digest(fid)
+        name = join(digest[:2],digest + splitext(target_path)[1])
+        object_path = join(self.path,'objects',name)
+        if not exists(object_path):
+            _link(target_path,object_path)
+        self.use(name)
+
+        index = self._index()
+        #other processes may publish variants of the same target meanwhile
+        with index.lock:
+            variants = [v for v in self.variants(target_id)
+                if v["deps"] != deps]
+            variants.append(dict(object=name,deps=deps))
+            index.set(target_id,variants[-self.max_variants:])
+
+    def materialize(self,name,target_path):
+        """
+        link the stored object into a project cache
+        """
+        _link(join(self.path,'objects',name),target_path)
+        self.use(name)
+
+    def gc(self,max_bytes=None,grace=3600.):
+        """
+        remove the objects that no variant refers to, then evict the least
+        recently used objects and their variants until the objects have a
+        total size of at most max_bytes. Objects added in the last grace
+        seconds are kept, as they might be published right now. Returns the
+        list of removed object names.
+        """
+        index = self._index()
+        last_use = self._used().refresh()
+        used = {}
+        for target_id, variants in index.refresh().iteritems():
+            for variant in variants:
+                used.setdefault(variant["object"],[]).append(target_id)
+
+        objects = join(self.path,'objects')
+        entries = []
+        removed = []
+        for prefix in listdir(objects) if isdir(objects) else []:
+            for name in listdir(join(objects,prefix)):
+                name = join(prefix,name)
+                st = lstat(join(objects,name))
+                #linking an object changes its ctime
+                if time() - st.st_ctime < grace:
+                    continue
+                if name in used:
+                    recency = last_use.get(name,st.st_mtime)
+                    entries.append((recency,st.st_size,name))
+                else:
+                    remove(join(objects,name))
+                    self._used().delete(name)
+                    removed.append(name)
+        entries.sort()
+
+        total = sum(entry[1] for entry in entries)
+        for recency, size, name in entries:
+            if max_bytes is None or total <= max_bytes:
+                break
+            remove(join(objects,name))
+            self._used().delete(name)
+            for target_id in used[name]:
+                with index.lock:
+                    variants = [v for v in index.refresh().get(target_id,[])
+                        if v["object"] != name]
+                    if variants:
+                        index.set(target_id,variants)
+                    else:
+                        index.delete(target_id)
+            total -= size
+            removed.append(name)
+        return removed
+
+class JobQueue:
+    """
+    Queue of jobs in a directory that is shared with worker processes,
+    possibly on other machines. Jobs are JSON dictionaries that move from
+    pending to running when a worker claims them, and the workers put a
+    result dictionary and an output file into done. Files needed by the
+    jobs are stored under the digest of their contents in blobs.
+
+    Workers hold a lease on the jobs they run, which they renew with
+    keep_alive. A job whose lease is not renewed for lease seconds, e.g.
+    because its worker died, or that is running for longer than the
+    timeout of collect plus grace seconds is given up, and its result is
+    discarded if the worker finishes it after all.
+    """
+    def __init__(self,path,lease=60.):
+        self.path = path
+        self.lease = lease
+        for name in ['blobs','pending','running','done']:
+            _makedirs(join(path,name))
+
+    def _write(self,data,path):
+        tmp_path = join(self.path,'.%s.%d.tmp' % (uuid4().hex,getpid()))
+        with open(tmp_path,'w','utf8') as fid:
+            json.dump(data,fid)
+        rename(tmp_path,path)
+
+    def put_blob(self,path):
+        """
+        store a copy of a file in the queue, returns its digest. A copy and
+        not a link, so that later edits of the file do not change the blob.
+        """
+        with open(path,'rb') as fid:
+            digest = file_digest(fid)
+        blob_path = join(self.path,'blobs',digest[:2],digest)
+        if exists(blob_path):
+            try:
+                #protect it from gc, which might be running right now
+                utime(blob_path,None)
+                return digest
+            except OSError:
+                #removed in the meantime
+                pass
+
+        tmp_path = join(self.path,'.%s.%d.tmp' % (uuid4().hex,getpid()))
+        try:
+            copy2(path,tmp_path)
+            #the file might have changed since it was hashed
+            with open(tmp_path,'rb') as fid:
+                digest = file_digest(fid)
+            blob_path = join(self.path,'blobs',digest[:2],digest)
+            _makedirs(dirname(blob_path))
+            rename(tmp_path,blob_path)
+        finally:
+            if exists(tmp_path):
+                remove(tmp_path)
+        return digest
+
+    def get_blob(self,digest,path):
+        """
+        get a stored file
+        """
+        _link(join(self.path,'blobs',digest[:2],digest),path)
+
+    def gc(self,grace=3600.):
+        """
+        remove the blobs that no pending or running job needs. Blobs that
+        were stored in the last grace seconds are kept, as the jobs needing
+        them might not be submitted yet. Returns the list of removed
+        digests.
+        """
+        needed = set()
+        #running twice, to see jobs that move between pending and running
+        for state in ['running','pending','running']:
+            for name in listdir(join(self.path,state)):
+                try:
+                    with open(join(self.path,state,name),'r','utf8') as fid:
+                        needed.update(json.load(fid)["files"].values())
+                except (IOError,OSError):
+                    #moved in the meantime
+                    continue
+
+        removed = []
+        blobs = join(self.path,'blobs')
+        for prefix in listdir(blobs):
+            for digest in listdir(join(blobs,prefix)):
+                path = join(blobs,prefix,digest)
+                if digest in needed or time() - lstat(path).st_ctime < grace:
+                    continue
+                remove(path)
+                removed.append(digest)
+        return removed
+
+    def submit(self,job):
+        """
+        add a job to the queue, returns the id of the job
+        """
+        #ids sort by submission time, so jobs are claimed in order
+        job_id = '%.6f-%s' % (time(),uuid4().hex)
+        self._write(job,join(self.path,'pending',job_id + '.json'))
+        return job_id
+
+    def claim(self):
+        """
+        take the oldest pending job, returns a tuple of job id and job or
+        None if there are no pending jobs
+        """
+        for name in sorted(listdir(join(self.path,'pending'))):
+            pending_path = join(self.path,'pending',name)
+            running_path = join(self.path,'running',name)
+            try:
+                #the modification time marks the last renewal of the lease.
+                #It is set before the job appears in running, so that its
+                #lease is never seen expired there.
+                utime(pending_path,None)
+                rename(pending_path,running_path)
+            except OSError:
+                #claimed by another worker
+                continue
+            with open(running_path,'r','utf8') as fid:
+                return splitext(name)[0], json.load(fid)
+        return None
+
+    def finish(self,job_id,result,output=None):
+        """
+        store the result dictionary of a claimed job and optionally the
+        file it created. The result is discarded if the job was given up.
+        """
+        try:
+            remove(join(self.path,'running',job_id + '.json'))
+        except OSError:
+            return
+        if output is not None:
+            _link(output,join(self.path,'done',job_id))
+        self._write(result,join(self.path,'done',job_id + '.json'))
+
+    def release(self,job_id):
+        """
+        put a claimed job back into the queue, unless it was given up
+        """
+        try:
+            rename(
+                join(self.path,'running',job_id + '.json'),
+                join(self.path,'pending',job_id + '.json')
+            )
+        except OSError:
+            pass
+
+    def withdraw(self,job_id):
+        """
+        remove a job if it is not claimed yet
+        """
+        try:
+            remove(join(self.path,'pending',job_id + '.json'))
+        except OSError:
+            pass
+
+    def renew(self,job_id):
+        """
+        renew the lease of a claimed job, returns False if it was given up
+        """
+        try:
+            utime(join(self.path,'running',job_id + '.json'),None)
+        except OSError:
+            return False
+        return True
+
+    def keep_alive(self,job_id):
+        """
+        renew the lease of a claimed job in a background thread, until the
+        returned Event is set
+        """
+        stop = Event()
+        def renew():
+            while not stop.wait(self.lease/3.):
+                if not self.renew(job_id):
+                    return
+        thread = Thread(target=renew)
+        thread.daemon = True
+        thread.start()
+        return stop
+
+    def _expired(self,job_id):
+        """
+        returns whether the lease of a running job was not renewed in time
+        """
+        try:
+            st = stat(join(self.path,'running',job_id + '.json'))
+        except OSError:
+            #not claimed yet or finished in the meantime
+            return False
+        return time() - st.st_mtime > self.lease
+
+    def _give_up(self,job_id):
+        """
+        give up a running job, returns whether it was given up
+        """
+        try:
+            remove(join(self.path,'running',job_id + '.json'))
+        except OSError:
+            #finished in the meantime
+            return False
+        return True
+
+    def _wait(self,job_id,poll,cancelled,timeout,grace):
+        """
+        wait for a job to finish, see collect
+        """
+        result_path = join(self.path,'done',job_id + '.json')
+        pending_path = join(self.path,'pending',job_id + '.json')
+        claimed = None
+        while not exists(result_path):
+            if cancelled is not None and cancelled.is_set():
+                raise Cancelled("Job %s cancelled" % job_id)
+            if self._expired(job_id) and self._give_up(job_id):
+                raise RenderError(
+                    "Job %s was given up, its worker stopped responding" %
+                    job_id
+                )
+            if claimed is None and not exists(pending_path):
+                claimed = time()
+            if timeout is not None and claimed is not None and \
+                    time() - claimed > timeout + grace and \
+                    self._give_up(job_id):
+                raise RenderError(
+                    "Job %s did not finish within %g s" % (job_id,timeout)
+                )
+            sleep(poll)
+
+    def collect(self,job_id,target,poll=0.1,cancelled=None,timeout=None,
+            grace=30.):
+        """
+        wait for a job to finish, and move the file it created to target.
+        returns the result dictionary. If the Event cancelled is set while
+        waiting, the job is withdrawn and Cancelled is raised. If the lease
+        of the job expires, or it is running for longer than timeout plus
+        grace seconds, RenderError is raised.
+        """
+        try:
+            self._wait(job_id,poll,cancelled,timeout,grace)
+        except BaseException:
+            #e.g. KeyboardInterrupt, the job is no longer needed
+            self.withdraw(job_id)
+            raise
+        result_path = join(self.path,'done',job_id + '.json')
+        with open(result_path,'r','utf8') as fid:
+            result = json.load(fid)
+        output_path = join(self.path,'done',job_id)
+        if exists(output_path):
+            move(output_path,target)
+        remove(result_path)
+        return result
+
+def _in_dir(path,create):
+    """
+    create the directory of path and call create, which creates the file at
+    path. If the directory is removed in the meantime, e.g. as it was empty,
+    it is created again.
+    """
+    _makedirs(dirname(path))
+    try:
+        return create()
+    except (IOError,OSError) as e:
+        if e.errno != errno.ENOENT or exists(dirname(path)):
+            raise
+    _makedirs(dirname(path))
+    return create()
+
+def _link(src,dst):
+    """
+    atomically create dst as hard link of src, or as copy if linking fails
+    """
+    _in_dir(dst,partial(_link_once,src,dst))
+
+def _link_once(src,dst):
+    tmp_path = '%s.%d.%d.tmp' % (dst,getpid(),current_thread().ident)
+    try:
+        link(src,tmp_path)
+    except OSError:
+        copy2(src,tmp_path)
+    rename(tmp_path,dst)
+    #rename does nothing if dst is already a link to the same file
+    if exists(tmp_path):
+        remove(tmp_path)
+
+def new_stats():
+    """
+    returns a dictionary with zeroed cache statistics. misses is a
+    dictionary with the number of misses for each reason.
+    """
+    return dict(
+        hits=0,
+        misses={},
+        shared_hits=0,
+        cached_failures=0,
+        failures=0,
+        callback_time=0.,
+        bytes_written=0
+    )
+
+def add_stats(total,stats):
+    """
+    returns the sum of two dictionaries of cache statistics
+    """
+    res = {}
+    for key in set(total.keys() + stats.keys()):
+        if isinstance(total.get(key,stats.get(key)),dict):
+            res[key] = add_stats(total.get(key,{}),stats.get(key,{}))
         else:
-            with open(dep_path,'r','utf8') as fid:
-                self.dependencies = json.loads(fid.read())
+            res[key] = total.get(key,0) + stats.get(key,0)
+    return res
+
+def format_duration(seconds):
+    """
+    format a number of seconds as hours, minutes and seconds
+    """
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh%02dm%02ds" % (seconds/3600,seconds/60 % 60,seconds % 60)
+    elif seconds >= 60:
+        return "%dm%02ds" % (seconds/60,seconds % 60)
+    return "%ds" % seconds
+
+class Progress:
+    """
+    Prints the number of finished jobs and the estimated remaining time,
+    based on the estimated durations of the jobs.
+    """
+    def __init__(self,estimates,stream=None):
+        self.stream = stream or sys.stderr
+        self.count = len(estimates)
+        self.total = sum(estimates)
+        self.done = 0
+        self.done_estimate = 0.
+        self.start = time()
+        self.write()
+
+    def update(self,estimate):
+        """
+        mark a job with the given estimated duration as finished
+        """
+        self.done += 1
+        self.done_estimate += estimate
+        self.write()
+
+    def write(self):
+        line = "\rRendering %d/%d" % (self.done,self.count)
+        if self.done_estimate > 0:
+            elapsed = time() - self.start
+            remaining = self.total - self.done_estimate
+            line += ", %s remaining" % \
+                format_duration(elapsed*remaining/self.done_estimate)
+        self.stream.write(line + "   ")
+        self.stream.flush()
+
+    def finish(self):
+        self.stream.write("\n")
+
+class RenderError(Exception):
+    """
+    Raised by the callbacks of FileCache.process if a file could not be
+    created. dependencies is a list of files that might fix the problem when
+    they are modified.
+    """
+    def __init__(self,message,dependencies=None):
+        Exception.__init__(self,message)
+        self.dependencies = dependencies or []
+
+class Cancelled(Exception):
+    """
+    Raised by the callbacks of FileCache.process if they were cancelled
+    """
+    pass
+
+class FileCache:
+    """
+    Context manager to allow caching. The context can be entered
+    repeatedly, the cached data is loaded when the outermost context is
+    entered and closed when it is left.
+
+    With check='mtime' a target is outdated if one of its dependencies was
+    modified after it. With check='content' it is outdated only if the
+    contents of one of its dependencies changed.
+
+    If max_bytes or max_entries are given, the least recently used targets
+    are evicted when the outermost context is left, until the cache fits
+    into this budget.
+
+    If failure_backoff is given, targets that could not be created are
+    not retried for this number of seconds, doubling with each failure,
+    unless one of their dependencies changes.
+
+    The time needed to create each target is stored in the .durations
+    journal. Outdated targets are created longest first, and if progress
+    is True, the progress and the estimated remaining time are printed.
+
+    Statistics about hits, misses and the time spent in callbacks are
+    collected in stats and stored in the .stats journal when the outermost
+    context is left.
+
+    Targets are stored in subdirectories named after the first two
+    characters of their id, to keep directories small. Caches with the
+    older flat layout are migrated when they are opened.
+
+    Several processes can share a cache directory. Targets are published
+    atomically and dependency data written by other processes is merged.
+
+    If shared is the path of a SharedCache, targets are exchanged with
+    the caches of other projects. As the targets are hard links to the
+    same file, their modification times are meaningless and the contents
+    of dependencies are checked.
+
+    If read_only is True, nothing is written to the cache directory, e.g.
+    to report the status of the targets without changing it.
+
+    memo is a dictionary for users of the cache to remember results for
+    the duration of the outermost context. It is emptied when the context
+    is left, so that later sessions check the targets again.
+    """
+    #journals of the DigestIndexes, pruned by gc
+    index_names = ['digests','blob_ids']
+
+    def __init__(self,path,jobs=1,check='mtime',max_bytes=None,
+            max_entries=None,shared=None,failure_backoff=None,progress=False,
+            keep_going=False,read_only=False):
+        assert check in ['mtime','content']
+        self.path = path
+        self.read_only = read_only
+        self.basedir = dirname(abspath(path))
+        self.jobs = jobs
+        self.check = check
+        self.shared = None
+        if not shared is None:
+            self.shared = SharedCache(shared)
+            self.check = 'content'
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.failure_backoff = failure_backoff
+        self.progress = progress
+        self.keep_going = keep_going
+        self.cancelled = Event()
+        self.cancel_hooks = []
+        self.depth = 0
+        self.journals = {}
+        self.indices = {}
+        self.dependencies = None
+        self.touched = set([])
+        self.stats = new_stats()
+        self.memo = {}
+
+    #version of the directory layout
+    layout = 'sharded'
+
+    def __enter__(self):
+        if self.depth == 0:
+            if not self.read_only:
+                self._migrate()
+            #load cached dependency data
+            self.dependencies = self.journal('deps').data
+            self.stats = new_stats()
+            self.memo = {}
+            self.touched = set([])
+        self.depth += 1
         return self
 
     def __exit__(self,exc_type,exc_val,exc_tb):
-        #write dependency data
-        with open(join(self.path,'.deps'),'w','utf8') as fid:
-            fid.write(json.dumps(self.dependencies))
+        self.depth -= 1
+        if self.depth == 0:
+            self.memo = {}
+        if self.depth == 0 and self.read_only:
+            self._close_journals()
+            self.dependencies = None
+        elif self.depth == 0:
+            if exc_type is None and \
+                    not (self.max_bytes is None and self.max_entries is None):
+                self.gc(self.max_bytes,self.max_entries)
+            self._save_stats()
+            self._close_journals()
             self.dependencies = None
+            if not self.shared is None:
+                self.shared.close()
         return False
 
+    def _save_stats(self):
+        """
+        store the statistics of this session and add them to the totals
+        """
+        if self.stats == new_stats():
+            return
+        stats = self.journal('stats')
+        stats.set('last',self.stats)
+        stats.set('total',add_stats(stats.get('total',new_stats()),self.stats))
+
+    def journal(self,name):
+        """
+        returns the journal with the given name that is stored in the cache
+        directory. It is loaded on first use and closed when the outermost
+        context is left.
+        """
+        if not name in self.journals:
+            self.journals[name] = Journal(join(self.path,'.' + name))
+        return self.journals[name]
+
+    def index(self,name,digest=file_digest):
+        """
+        returns the DigestIndex for checksums calculated by the function
+        digest, that is stored in the journal with the given name. It is
+        closed together with the journals.
+        """
+        if not name in self.indices:
+            self.indices[name] = DigestIndex(
+                self.journal(name),
+                digest,
+                read_only=self.read_only
+            )
+        return self.indices[name]
+
+    def _close_journals(self):
+        for index in self.indices.values():
+            index.close()
+        self.indices = {}
+        for journal in self.journals.values():
+            journal.close(compact=not self.read_only)
+        self.journals = {}
+
+    def digest(self,path):
+        """
+        returns the content digest of the file at path
+        """
+        return self.index('digests').digest(path)
+
+    def parsed(self,path,parse):
+        """
+        returns parse(path). The result is marshalled in the cache under
+        the content digest of the file, so unchanged files are not parsed
+        again. Only the result for the current version of each file is
+        kept. marshal can only restore plain data, so the cache can not be
+        used to run code. Results that can not be marshalled, e.g. with
+        dates, are parsed each time.
+        """
+        digest = self.digest(path)
+        data_path = join(self.path,'.marshalled',digest + '.marshal')
+        if exists(data_path):
+            try:
+                with open(data_path,'rb') as fid:
+                    return marshal.load(fid)
+            except Exception:
+                #damaged, parse again
+                pass
+
+        res = parse(path)
+        if self.read_only:
+            return res
+        try:
+            data = marshal.dumps(res)
+        except ValueError:
+            return res
+        _makedirs(dirname(data_path))
+        tmp_path = '%s.%d.tmp' % (data_path,getpid())
+        with open(tmp_path,'wb') as fid:
+            fid.write(data)
+        rename(tmp_path,data_path)
+
+        old = self.journal('parsed').get(abspath(path))
+        if not old in [None,digest]:
+            old_path = join(self.path,'.marshalled',old + '.marshal')
+            if exists(old_path):
+                remove(old_path)
+        self.journal('parsed').set(abspath(path),digest)
+        return res
+
+    def _fingerprint(self,deps):
+        """
+        returns a dictionary with the content digests of the dependencies
+        """
+        return dict((dep,self.digest(dep)) for dep in deps)
+
     def clear(self):
         """
         Clear the cache and all files in it
         """
+        self._close_journals()
         rmtree(self.path)
         makedirs(self.path)
-        self.dependencies = {}
+        self._migrate()
+        if self.depth > 0:
+            self.dependencies = self.journal('deps').data
+        else:
+            self.dependencies = None
 
-    def process(self,callback,**kwargs):
+    def _migrate(self):
         """
-        calls the callable callback to create a file and returns its path.
-        the callback must return a list of file paths the created file
-        depends on and which make reexecution of the callback necessary if
-        modified. Alternatively None can be returned to retry 
-        additional keyword arguments can be used to supply any information to
-        callback and dependencies. An id of the calling importer is required
-        and an extension for the resulting file is required.
+        move targets stored in the flat layout of older versions into
+        subdirectories
+        """
+        layout_path = join(self.path,'.layout')
+        if not isdir(self.path) or exists(layout_path):
+            return
+        lock = FileLock(layout_path + '.lock')
+        with lock:
+            if not exists(layout_path):
+                for filename in listdir(self.path):
+                    path = join(self.path,filename)
+                    if TARGET_RE.match(filename) is None or not isfile(path):
+                        continue
+                    target_path = self._target_path(filename.split('.')[0],
+                        splitext(filename)[1])
+                    if not exists(dirname(target_path)):
+                        makedirs(dirname(target_path))
+                    rename(path,target_path)
+                with open(layout_path,'w','utf8') as fid:
+                    fid.write(self.layout)
+        lock.close()
 
-        callback(target_filename,importer='imp_id',extension='.png',**kwargs)
+    def _target_path(self,target_id,extension):
+        return join(self.path,target_id[:2],target_id + extension)
+
+    def _targets(self):
+        """
+        returns a list of the ids and paths of all targets in the cache
+        """
+        targets = []
+        for shard_name in listdir(self.path):
+            shard = join(self.path,shard_name)
+            if len(shard_name) != 2 or not isdir(shard):
+                continue
+            for filename in listdir(shard):
+                if filename.startswith('.'):
+                    continue
+                targets.append((filename.split('.')[0],join(shard,filename)))
+        return targets
+
+    def _remove(self,target_id,target_path=None):
+        """
+        remove a target and all data stored about it
+        """
+        if not target_path is None and exists(target_path):
+            remove(target_path)
+        self.journal('deps').delete(target_id)
+        self.journal('fingerprints').delete(target_id)
+        self.journal('failures').delete(target_id)
+        self.journal('durations').delete(target_id)
+        self.journal('used').delete(target_id)
+
+    def add_root(self,document):
+        """
+        record that the targets used since the cache was opened are needed
+        to build document
+        """
+        self.journal('roots').set(document,sorted(self.touched))
+
+    def remove_orphans(self):
+        """
+        remove all targets that were neither used by the last recorded build
+        of an existing document nor since the cache was opened. Returns the
+        list of removed target ids, or None if no build was recorded yet,
+        e.g. in a cache of an older version, as then all targets would be
+        removed.
+        """
+        roots = self.journal('roots')
+        if not roots.data:
+            return None
+        reachable = set(self.touched)
+        for document in roots.data.keys():
+            if not exists(document):
+                roots.delete(document)
+            else:
+                reachable.update(roots[document])
+
+        removed = []
+        for target_id, target_path in self._targets():
+            if not target_id in reachable:
+                self._remove(target_id,target_path)
+                removed.append(target_id)
+        self._remove_empty_shards()
+
+        #entries without target file
+        for target_id in self.dependencies.keys():
+            if not target_id in reachable:
+                self._remove(target_id)
+        return removed
+
+    def _remove_empty_shards(self):
+        for shard_name in listdir(self.path):
+            if len(shard_name) != 2:
+                continue
+            try:
+                rmdir(join(self.path,shard_name))
+            except OSError:
+                #not empty or not a directory
+                pass
+
+    def gc(self,max_bytes=None,max_entries=None):
+        """
+        evict the least recently used targets until at most max_entries
+        targets with a total size of at most max_bytes are left. Targets
+        used since the cache was opened are never evicted. The digests of
+        files that no longer exist are forgotten. Returns the list of
+        evicted target ids.
+        """
+        for name in self.index_names:
+            DigestIndex(self.journal(name)).prune()
+
+        last_use = self.journal('used')
+        entries = []
+        for target_id, target_path in self._targets():
+            st = lstat(target_path)
+            recency = last_use.get(target_id,st.st_mtime)
+            entries.append((recency,st.st_size,target_id,target_path))
+        entries.sort()
+
+        total = sum(entry[1] for entry in entries)
+        count = len(entries)
+        evicted = []
+        for recency, size, target_id, target_path in entries:
+            if (max_bytes is None or total <= max_bytes) and \
+                    (max_entries is None or count <= max_entries):
+                break
+            if target_id in self.touched:
+                continue
+            self._remove(target_id,target_path)
+            total -= size
+            count -= 1
+            evicted.append(target_id)
+        self._remove_empty_shards()
+        return evicted
+
+    def target_id(self,kwargs):
+        """
+        returns the id of the file created for the keyword arguments
+        """
+        return self._target(kwargs)[0]
+
+    def _target(self,kwargs):
+        """
+        returns id and path of the file created for the keyword arguments
         """
         assert 'importer' in kwargs
         assert 'extension' in kwargs
@@ -77,36 +1398,414 @@ class FileCache:
 
         target_id = m.hexdigest()
 
-        #check if update is nessecary
-        update = False
-
-        target_path = join(self.path,target_id + kwargs["extension"])
+        return target_id, self._target_path(target_id,kwargs["extension"])
 
+    def _needs_update(self,target_id,target_path):
+        """
+        check whether the target has to be (re)created, returns the reason
+        or None if it is up to date
+        """
         if not exists(target_path):
-#            print "Target path for %s does not exist" % target_id
-            update = True
+            return 'missing_target'
         elif not target_id in self.dependencies:
-#            print "Dependencies for %s do not exist" % target_id
-            update = True
+            return 'missing_entry'
         elif self.dependencies[target_id] is None:
             #The callback requested to try again next time
-            update = True
+            return 'retry'
+
+        deps = self.dependencies[target_id]
+        for dep in deps:
+            if not exists(dep):
+                return 'missing_dependency'
+
+        if self.check == 'content' and \
+                target_id in self.journal('fingerprints'):
+            fingerprint = self.journal('fingerprints')[target_id]
+            for dep in deps:
+                if fingerprint.get(dep) != self.digest(dep):
+                    return 'changed_dependency'
+            return None
+
+        target_time = lstat(target_path).st_mtime
+        for dep in deps:
+            if lstat(dep).st_mtime > target_time:
+                return 'stale_dependency'
+
+        if self.check == 'content' and not self.read_only:
+            #up to date, but created without content check
+            self.journal('fingerprints').set(target_id,self._fingerprint(deps))
+        return None
+
+    def _use(self,target_id,target_path):
+        """
+        mark a target as used for the least recently used eviction, also
+        in the shared cache.
+        """
+        if not target_id in self.touched:
+            self.touched.add(target_id)
+            if self.read_only or not exists(target_path):
+                return
+            _record_use(self.journal('used'),target_id)
+            if not self.shared is None:
+                digest = self.digest(target_path)
+                self.shared.use(
+                    join(digest[:2],digest + splitext(target_path)[1])
+                )
+
+    def _create(self,callback,target_id,target_path,kwargs):
+        """
+        call the callback to create a target. The callback writes to a
+        temporary file that is then renamed, so that other processes never
+        see incomplete targets.
+        """
+        tmp_path = join(
+            self.path,
+            '.%s.%d%s' % (target_id,getpid(),kwargs["extension"])
+        )
+        try:
+            deps = callback(tmp_path,**kwargs)
+            if exists(tmp_path):
+                _in_dir(target_path,partial(rename,tmp_path,target_path))
+        finally:
+            if exists(tmp_path):
+                remove(tmp_path)
+        return deps
+
+    def on_cancel(self,hook):
+        """
+        register a function that is called without arguments when the
+        running callbacks are cancelled. It should make them raise
+        Cancelled promptly.
+        """
+        if not hook in self.cancel_hooks:
+            self.cancel_hooks.append(hook)
+
+    def cancel(self):
+        """
+        cancel the creation of targets, targets that are not yet started
+        are skipped and the running callbacks are cancelled
+        """
+        self.cancelled.set()
+        for hook in self.cancel_hooks:
+            hook()
+
+    def _estimates(self,target_ids):
+        """
+        returns a list with the estimated time in seconds to create the
+        targets, based on the last time they were created. For new targets
+        the average is used.
+        """
+        durations = self.journal('durations')
+        known = [durations[t][0] for t in target_ids if t in durations]
+        default = sum(known)/len(known) if known else 1.
+        return [durations[t][0] if t in durations else default
+            for t in target_ids]
+
+    def _inputs(self,kwargs):
+        """
+        returns a JSON serializable description of the arguments of a
+        callback
+        """
+        return dict((k,str(v)) for k,v in kwargs.iteritems())
+
+    def _cached_failure(self,target_id,target_path):
+        """
+        returns the information about a recent failure to create the target
+        or None if it should be created. A failure is forgotten after the
+        backoff time or if one of the dependencies changes.
+        """
+        if self.failure_backoff is None:
+            return None
+        failure = self.journal('failures').get(target_id)
+        if failure is None or time() > self._retry_time(failure):
+            return None
+        if failure["fingerprint"] != \
+                self._failure_fingerprint(failure["dependencies"]):
+            return None
+        if failure["message"] is None and not exists(target_path):
+            return None
+        return failure
+
+    def _retry_time(self,failure):
+        """
+        returns the time after which a failed target is created again. The
+        backoff time doubles with every consecutive failure.
+        """
+        return failure["time"] + \
+            self.failure_backoff*2**min(failure["count"] - 1,7)
+
+    def _failure_fingerprint(self,deps):
+        return dict((dep,self.digest(dep) if exists(dep) else None)
+            for dep in deps)
+
+    def _fail(self,target_id,kwargs,message,deps):
+        """
+        remember that creating the target failed
+        """
+        if self.failure_backoff is None:
+            return
+        failure = self.journal('failures').get(target_id)
+        count = 1 if failure is None else failure["count"] + 1
+        self.journal('failures').set(target_id,dict(
+            inputs=self._inputs(kwargs),
+            message=message,
+            dependencies=deps,
+            fingerprint=self._failure_fingerprint(deps),
+            count=count,
+            time=time()
+        ))
+
+    def _update(self,target_id,target_path,deps):
+        """
+        store the dependencies of a freshly created target
+        """
+        self.journal('deps').set(target_id,deps)
+        utime(target_path,None)
+        if not deps is None:
+            self.journal('failures').delete(target_id)
+        if self.check != 'content' or deps is None:
+            #a fingerprint of the previous contents would be wrong now
+            self.journal('fingerprints').delete(target_id)
         else:
-            target_time = lstat(target_path).st_mtime
-            for dep in self.dependencies[target_id]:
-                if not exists(dep):
-#                    print "Dependency %s for %s does not exist" % (dep,target_id)
-                    update = True
-                    break
-                elif lstat(dep).st_mtime > target_time:
-#                    print "Dependency %s for %s is outdated" % (dep,target_id)
-#                    print target_time, lstat(dep).st_mtime
-                    update = True
+            fingerprint = self._fingerprint(deps)
+            self.journal('fingerprints').set(target_id,fingerprint)
+            if not self.shared is None:
+                self.shared.publish(target_id,target_path,
+                    [[self._relative(dep),fingerprint[dep]] for dep in deps])
+
+    def _relative(self,path):
+        """
+        returns the path relative to the project, if it is inside of it
+        """
+        path = abspath(path)
+        if relpath(path,self.basedir).startswith('..'):
+            return path
+        return relpath(path,self.basedir)
+
+    def _shared_variant(self,target_id):
+        """
+        returns the object name and the dependencies of a variant of the
+        target in the shared cache that matches the dependencies in the
+        project, or None
+        """
+        if self.shared is None:
+            return None
+        for variant in self.shared.variants(target_id):
+            deps = []
+            for dep, digest in variant["deps"]:
+                if not isabs(dep):
+                    dep = join(self.basedir,dep)
+                if not exists(dep) or self.digest(dep) != digest:
                     break
+                deps.append(dep)
+            else:
+                return variant["object"], deps
+        return None
+
+    def _fetch(self,target_id,target_path):
+        """
+        try to get an outdated target from the shared cache, returns True
+        on success
+        """
+        variant = self._shared_variant(target_id)
+        if variant is None:
+            return False
+        name, deps = variant
+        self.shared.materialize(name,target_path)
+        self.journal('deps').set(target_id,deps)
+        self.journal('fingerprints').set(target_id,self._fingerprint(deps))
+        return True
+
+    def status(self,jobs):
+        """
+        like process_many, but instead of creating anything, returns a
+        list with a dictionary for each job describing its target. state
+        is 'fresh', 'stale', 'shared' if it can be taken from the shared
+        cache or 'failed' if it failed recently. reason is the reason why
+        it is outdated and estimate the time it took to create it last
+        time, or None. To leave the cache unchanged, open it read_only.
+        """
+        self.journal('deps').refresh()
+
+        res = []
+        for callback, kwargs in jobs:
+            target_id, target_path = self._target(kwargs)
+            reason = self._needs_update(target_id,target_path)
+            state = 'fresh'
+            if reason is None:
+                pass
+            elif not self._shared_variant(target_id) is None:
+                state = 'shared'
+            elif not self._cached_failure(target_id,target_path) is None:
+                state = 'failed'
+            else:
+                state = 'stale'
+
+            duration = self.journal('durations').get(target_id)
+            res.append(dict(
+                target=target_id,
+                path=target_path,
+                state=state,
+                reason=reason,
+                estimate=None if duration is None else duration[0],
+                inputs=self._inputs(kwargs)
+            ))
+        return res
+
+    def process(self,callback,**kwargs):
+        """
+        calls the callable callback to create a file and returns its path.
+        the callback must return a list of file paths the created file
+        depends on and which make reexecution of the callback necessary if
+        modified. Alternatively None can be returned to retry 
+        additional keyword arguments can be used to supply any information to
+        callback and dependencies. An id of the calling importer is required
+        and an extension for the resulting file is required.
+
+        If the file can not be created, the callback raises a RenderError.
+        With a failure_backoff, failures are remembered and not retried
+        until a dependency changes or the backoff time passed, instead the
+        RenderError is raised again.
+
+        callback(target_filename,importer='imp_id',extension='.png',**kwargs)
+        """
+        return self.process_many([(callback,kwargs)])[0]
+
+    def process_many(self,jobs):
+        """
+        like process, but for a list of (callback, kwargs) tuples. All
+        outdated targets are collected first and then created using up to
+        self.jobs callbacks running in parallel, or all at once if
+        self.jobs is None, e.g. for callbacks that wait for other machines.
+        Returns a list of (path, dependencies) tuples in the order of the
+        jobs.
+
+        As the callbacks are executed in threads, they have to be thread
+        safe. This is the case for callbacks spending most of their time in
+        subprocesses.
+
+        If a target fails, the creation of the others is cancelled, unless
+        keep_going is set, and the first RenderError is raised afterwards.
+        The creation is also cancelled on KeyboardInterrupt or any other
+        exception. Targets that were created before are kept.
+        """
+        self.journal('deps').refresh()
+        self.cancelled.clear()
+
+        targets = []
+        stale = []
+        errors = []
+        seen = set([])
+        for callback, kwargs in jobs:
+            target_id, target_path = self._target(kwargs)
+            targets.append((target_id,target_path))
+            if target_id in seen:
+                continue
+            seen.add(target_id)
+
+            reason = self._needs_update(target_id,target_path)
+            if reason is None:
+                self.stats["hits"] += 1
+                continue
+            misses = self.stats["misses"]
+            misses[reason] = misses.get(reason,0) + 1
+            if self._fetch(target_id,target_path):
+                self.stats["shared_hits"] += 1
+                continue
+
+            failure = self._cached_failure(target_id,target_path)
+            if failure is None:
+                stale.append((callback,target_id,target_path,kwargs))
+                continue
+            self.stats["cached_failures"] += 1
+            if not failure["message"] is None:
+                errors.append(RenderError(
+                    "%s (cached failure, retry after %s)" % (
+                        failure["message"],
+                        ctime(self._retry_time(failure))
+                    ),
+                    failure["dependencies"]
+                ))
+
+        #start the longest jobs first to minimize the total time
+        estimates = self._estimates([job[1] for job in stale])
+        order = sorted(range(len(stale)),key=lambda i: -estimates[i])
+        progress = None
+        if self.progress and stale:
+            progress = Progress(estimates)
+
+        def run(i):
+            if self.cancelled.is_set():
+                return i, Cancelled(), 0.
+            start = time()
+            try:
+                deps = self._create(*stale[i])
+            except (RenderError,Cancelled) as e:
+                deps = e
+            return i, deps, time() - start
+
+        def finished(i,deps,duration):
+            #record each target as soon as it is done, so that it is kept
+            #if the others are interrupted
+            if progress:
+                progress.update(estimates[i])
+            if isinstance(deps,Cancelled):
+                return
+            callback, target_id, target_path, kwargs = stale[i]
+            self.stats["callback_time"] += duration
+            if isinstance(deps,RenderError):
+                self.stats["failures"] += 1
+                self._fail(target_id,kwargs,str(deps),deps.dependencies)
+                errors.append(deps)
+                if not self.keep_going:
+                    self.cancel()
+                return
+            if exists(target_path):
+                self.stats["bytes_written"] += lstat(target_path).st_size
+            if deps is None:
+                #The callback requested to try again next time
+                self._fail(target_id,kwargs,None,[])
+            self.journal('durations').set(target_id,[
+                round(duration,3),
+                self._inputs(kwargs)
+            ])
+            self._update(target_id,target_path,deps)
+
+        pool = None
+        try:
+            parallel = len(stale) if self.jobs is None else self.jobs
+            if parallel > 1 and len(stale) > 1:
+                pool = ThreadPool(min(parallel,len(stale)))
+                it = pool.imap_unordered(run,order)
+                while True:
+                    #wait with a timeout, to not block KeyboardInterrupt
+                    try:
+                        finished(*it.next(0.1))
+                    except TimeoutError:
+                        continue
+                    except StopIteration:
+                        break
+            else:
+                for i in order:
+                    finished(*run(i))
+        except BaseException:
+            #e.g. KeyboardInterrupt or a callback failing unexpectedly
+            self.cancel()
+            raise
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if progress:
+                progress.finish()
+
+        if errors:
+            raise errors[0]
+        if self.cancelled.is_set():
+            raise Cancelled("Cancelled")
 
-        if update:
-#            print "Updating %s" % target_id
-            self.dependencies[target_id] = callback(target_path,**kwargs)
-            utime(target_path,None)
+        for target_id, target_path in targets:
+            self._use(target_id,target_path)
 
-        return target_path, self.dependencies[target_id]
+        return [(path, self.dependencies[target_id])
+            for target_id, path in targets]
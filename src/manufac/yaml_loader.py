@@ -15,26 +15,75 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-from os.path import join,dirname, exists, basename
+from os.path import join,dirname, exists, basename, abspath
 from os import makedirs
 
 from pkg_resources import iter_entry_points
 import pkg_resources
 
 from manufac.utils import FileCache
-from manufac.importers.common import GraphScaffolding
+from manufac.importers.common import GraphScaffolding, load_documents
+from manufac.importers.common import blob_index, document_blobs
 
-def load_graph(input_file,store):
+def _importers(basedir,importer_options):
+    importer_options = importer_options or {}
     importers = []
-    basedir = dirname(input_file)
     for ep in iter_entry_points('importers'):
-        importers.append(ep.load()(basedir))
+        importers.append(ep.load()(basedir,**importer_options.get(ep.name,{})))
+    return importers
+
+def load_graph(input_file,store,importer_options=None,stats=None,
+        **cache_options):
+    """
+    load the graph from a YAML file. importer_options is a dictionary
+    with keyword arguments for each importer by name. If stats is a
+    dictionary, it is updated with the statistics of the FileCache for
+    this load. Additional keyword arguments are passed on to the FileCache.
+    """
+    basedir = dirname(input_file)
+    importers = _importers(basedir,importer_options)
 
     cachedir = join(basedir,'.mlcache')
     if not exists(cachedir):
         makedirs(cachedir)
 
-    scaf = GraphScaffolding(input_file,store,FileCache(cachedir),importers)
+    #keep the cache open for the whole include tree
+    cache = FileCache(cachedir,**cache_options)
+    with cache:
+        #create the files for the whole include tree at once
+        documents = load_documents(input_file,cache)
+        #hash the images and files while the importers run
+        blob_index(cache).prefetch(document_blobs(documents))
+        for imp in importers:
+            imp.prepare(cache,documents)
+
+        scaf = GraphScaffolding(input_file,store,cache,importers)
+        cache.add_root(abspath(input_file))
 
+    if stats is not None:
+        stats.update(cache.stats)
     return scaf.get_graph()
 
+
+def plan_graph(input_file,importer_options=None,**cache_options):
+    """
+    determine which files would be created when loading the graph from
+    a YAML file, without creating them. Returns a list of dictionaries
+    as described in FileCache.status, one for each file. Nothing is
+    written to the cache.
+    """
+    basedir = dirname(input_file)
+    importers = _importers(basedir,importer_options)
+
+    res = []
+    seen = set()
+    cachedir = join(basedir,'.mlcache')
+    with FileCache(cachedir,read_only=True,**cache_options) as cache:
+        documents = load_documents(input_file,cache)
+        for imp in importers:
+            for status in imp.plan(cache,documents):
+                if status["target"] in seen:
+                    continue
+                seen.add(status["target"])
+                res.append(status)
+    return res
@@ -1,9 +1,14 @@
 import unittest
 import json
-from os import makedirs, utime
+import yaml
+from os import makedirs, utime, lstat, walk, getpid, rename, remove, listdir
+from os.path import exists, basename, join, dirname, abspath
 from shutil import rmtree
 from codecs import open
-from time import sleep
+from time import sleep, time
+from threading import Event, Lock
+from multiprocessing.pool import ThreadPool
+from multiprocessing import Process
 
 from manufac.utils import *
 
@@ -13,8 +18,10 @@ class CallCounter:
         self.last_args = None
         self.last_kwargs = None
         self.callback = callback
+        self.lock = Lock()
     def __call__(self,*args,**kwargs):
-        self.call_count += 1
+        with self.lock:
+            self.call_count += 1
         self.last_args = args
         self.last_kwargs = kwargs
         return self.callback(*args,**kwargs)
@@ -23,10 +30,33 @@ def mock_callback(fn,**kwargs):
     open(fn,'w','utf8').close()
     return ['tests/cache/test/dep1']
 
+def failing_callback(fn,**kwargs):
+    raise RenderError("Failed",['tests/cache/failures/dep1'])
+
 def retry_callback(fn,**kwargs):
     open(fn,'w','utf8').close()
     return None
 
+def journal_writer(path,n):
+    #writes unique keys, compacting after each one
+    journal = Journal(path)
+    for i in range(30):
+        journal.set('%d-%d' % (n,i),i)
+        for j in range(5):
+            journal.set('counter-%d' % n,j)
+        journal.compact()
+    journal.close()
+
+def variant_publisher(path,n):
+    #publishes variants of the same target with different dependencies
+    shared = SharedCache(path)
+    for i in range(2):
+        target = join(dirname(path),'%d-%d.tmp' % (n,i))
+        with open(target,'w','utf8') as fid:
+            fid.write('%d-%d' % (n,i))
+        shared.publish('target',target,[['dep','%d-%d' % (n,i)]])
+    shared.close()
+
 class CacheTest(unittest.TestCase):
     def test_cold_start(self):
         rmtree('tests/cache/cold',True)
@@ -124,3 +154,886 @@ class CacheTest(unittest.TestCase):
             self.assertEqual(callback.call_count,2)
 
 
+    def test_parallel(self):
+        rmtree('tests/cache/parallel',True)
+        makedirs('tests/cache/parallel')
+        open('tests/cache/test/dep1','w','utf8').close()
+        with FileCache('tests/cache/parallel',jobs=4) as fc:
+            callback = CallCounter(mock_callback)
+            jobs = [(callback,dict(importer='test',extension='.tmp',arg=i))
+                for i in [1,2,3,2,4]]
+
+            results = fc.process_many(jobs)
+            self.assertEqual(callback.call_count,4)
+            self.assertEqual(len(results),5)
+            self.assertEqual(results[1],results[3])
+            for path, deps in results:
+                self.assertTrue(exists(path))
+                self.assertEqual(deps,['tests/cache/test/dep1'])
+
+            fc.process_many(jobs)
+            self.assertEqual(callback.call_count,4)
+
+            self.assertEqual(
+                fc.process(callback,importer='test',extension='.tmp',arg=3),
+                results[2]
+            )
+            self.assertEqual(callback.call_count,4)
+
+    def test_parallel_cold(self):
+        #many targets share the shard directories created in parallel
+        rmtree('tests/cache/cold_parallel',True)
+        makedirs('tests/cache/cold_parallel')
+        open('tests/cache/test/dep1','w','utf8').close()
+        callback = CallCounter(mock_callback)
+        jobs = [(callback,dict(importer='test',extension='.tmp',arg=i))
+            for i in range(2000)]
+        with FileCache('tests/cache/cold_parallel',jobs=8) as fc:
+            results = fc.process_many(jobs)
+            self.assertEqual(callback.call_count,2000)
+            for path, deps in results:
+                self.assertTrue(exists(path))
+            self.assertEqual(len(fc.journal('deps').data),2000)
+
+    def test_unchanged(self):
+        rmtree('tests/cache/unchanged',True)
+        makedirs('tests/cache/unchanged')
+        open('tests/cache/unchanged/dep1','w','utf8').close()
+        def callback(fn,**kwargs):
+            open(fn,'w','utf8').close()
+            return ['tests/cache/unchanged/dep1']
+
+        with FileCache('tests/cache/unchanged') as fc:
+            fc.process(callback,importer='test',extension='.tmp',arg=4)
+        before = lstat('tests/cache/unchanged/.deps')
+
+        sleep(0.1)
+        with FileCache('tests/cache/unchanged') as fc:
+            fc.process(callback,importer='test',extension='.tmp',arg=4)
+        after = lstat('tests/cache/unchanged/.deps')
+        self.assertEqual(before.st_mtime,after.st_mtime)
+        self.assertEqual(before.st_size,after.st_size)
+
+    def test_reentrant(self):
+        rmtree('tests/cache/reentrant',True)
+        makedirs('tests/cache/reentrant')
+        fc = FileCache('tests/cache/reentrant')
+        with fc:
+            with fc:
+                fc.journal('deps').set('a',['b'])
+            self.assertEqual(fc.dependencies,{'a' : ['b']})
+        self.assertEqual(fc.dependencies,None)
+
+        #the memo lasts for the outermost context
+        with fc:
+            with fc:
+                fc.memo['a'] = 'b'
+            self.assertEqual(fc.memo,{'a' : 'b'})
+        self.assertEqual(fc.memo,{})
+        with fc:
+            self.assertEqual(fc.memo,{})
+
+    def test_content(self):
+        rmtree('tests/cache/content',True)
+        makedirs('tests/cache/content')
+        with open('tests/cache/content/dep1','w','utf8') as fid:
+            fid.write('foo')
+        def callback(fn,**kwargs):
+            open(fn,'w','utf8').close()
+            return ['tests/cache/content/dep1']
+        callback = CallCounter(callback)
+
+        with FileCache('tests/cache/content',check='content') as fc:
+            fc.process(callback,importer='test',extension='.tmp',arg=4)
+            self.assertEqual(callback.call_count,1)
+
+            #modification time changes, but contents are the same
+            sleep(0.1)
+            utime('tests/cache/content/dep1',None)
+            fc.process(callback,importer='test',extension='.tmp',arg=4)
+            self.assertEqual(callback.call_count,1)
+
+            sleep(0.1)
+            with open('tests/cache/content/dep1','w','utf8') as fid:
+                fid.write('bar')
+            fc.process(callback,importer='test',extension='.tmp',arg=4)
+            self.assertEqual(callback.call_count,2)
+
+        #unchanged files are not hashed again, once they are old enough
+        past = time() - 10
+        utime('tests/cache/content/dep1',(past,past))
+        with FileCache('tests/cache/content',check='content') as fc:
+            digest = fc.digest('tests/cache/content/dep1')
+        with FileCache('tests/cache/content',check='content') as fc:
+            index = DigestIndex(fc.journal('digests'),digest=None)
+            self.assertEqual(index.digest('tests/cache/content/dep1'),digest)
+
+    def test_mixed_checks(self):
+        rmtree('tests/cache/mixed',True)
+        makedirs('tests/cache/mixed')
+        def write(contents):
+            with open('tests/cache/mixed/dep1','w','utf8') as fid:
+                fid.write(contents)
+        def callback(fn,**kwargs):
+            with open(fn,'w','utf8') as fid:
+                fid.write(open('tests/cache/mixed/dep1').read())
+            return ['tests/cache/mixed/dep1']
+
+        write('A')
+        with FileCache('tests/cache/mixed',check='content') as fc:
+            fc.process(callback,importer='test',extension='.tmp',arg=1)
+        sleep(0.1)
+        write('B')
+        with FileCache('tests/cache/mixed') as fc:
+            fc.process(callback,importer='test',extension='.tmp',arg=1)
+        sleep(0.1)
+
+        #the fingerprint of A is gone after the mtime build recreated it
+        write('A')
+        with FileCache('tests/cache/mixed',check='content') as fc:
+            path, deps = fc.process(callback,importer='test',extension='.tmp',arg=1)
+        self.assertEqual(open(path).read(),'A')
+
+    def test_gc(self):
+        rmtree('tests/cache/gc',True)
+        makedirs('tests/cache/gc')
+        callback = CallCounter(mock_callback)
+
+        paths = []
+        for arg in range(3):
+            with FileCache('tests/cache/gc') as fc:
+                path, deps = fc.process(callback,importer='test',extension='.tmp',arg=arg)
+                #make the times of use differ
+                fc.journal('used').set(fc.target_id(callback.last_kwargs),1000 + arg)
+            paths.append(path)
+
+        #the least recently used target is evicted
+        with FileCache('tests/cache/gc') as fc:
+            self.assertEqual(len(fc.gc(max_entries=2)),1)
+            self.assertEqual(len(fc.dependencies),2)
+        self.assertFalse(exists(paths[0]))
+        self.assertTrue(exists(paths[1]))
+
+        #using a target leaves its modification time exactly as it is
+        mtime = lstat(paths[1]).st_mtime
+        with FileCache('tests/cache/gc') as fc:
+            target_id = fc.target_id(dict(importer='test',extension='.tmp',arg=1))
+            fc.journal('used').set(target_id,0)
+            fc.process(callback,importer='test',extension='.tmp',arg=1)
+        self.assertEqual(lstat(paths[1]).st_mtime,mtime)
+
+        #targets used in this session are kept
+        with FileCache('tests/cache/gc',max_entries=1) as fc:
+            fc.process(callback,importer='test',extension='.tmp',arg=1)
+        self.assertTrue(exists(paths[1]))
+        self.assertFalse(exists(paths[2]))
+
+    def test_orphans(self):
+        rmtree('tests/cache/orphans',True)
+        makedirs('tests/cache/orphans/.mlcache')
+        open('tests/cache/orphans/doc.yaml','w','utf8').close()
+        callback = CallCounter(mock_callback)
+
+        #nothing is removed before a build was recorded
+        with FileCache('tests/cache/orphans/.mlcache') as fc:
+            old, deps = fc.process(callback,importer='test',extension='.tmp',arg=1)
+        with FileCache('tests/cache/orphans/.mlcache') as fc:
+            self.assertEqual(fc.remove_orphans(),None)
+        self.assertTrue(exists(old))
+
+        with FileCache('tests/cache/orphans/.mlcache') as fc:
+            old, deps = fc.process(callback,importer='test',extension='.tmp',arg=1)
+            fc.add_root('tests/cache/orphans/doc.yaml')
+        with FileCache('tests/cache/orphans/.mlcache') as fc:
+            new, deps = fc.process(callback,importer='test',extension='.tmp',arg=2)
+            fc.add_root('tests/cache/orphans/doc.yaml')
+        with FileCache('tests/cache/orphans/.mlcache') as fc:
+            self.assertEqual(len(fc.remove_orphans()),1)
+            self.assertEqual(len(fc.dependencies),1)
+        self.assertFalse(exists(old))
+        self.assertTrue(exists(new))
+        #empty shards are removed
+        self.assertFalse(exists(dirname(old)))
+
+        #targets of earlier sessions of the same instance are not roots
+        fc = FileCache('tests/cache/orphans/.mlcache')
+        with fc:
+            fc.process(callback,importer='test',extension='.tmp',arg=3)
+        with fc:
+            fc.add_root('tests/cache/orphans/doc.yaml')
+            self.assertEqual(fc.journal('roots')['tests/cache/orphans/doc.yaml'],[])
+
+    def test_shared(self):
+        rmtree('tests/cache/shared',True)
+        makedirs('tests/cache/shared')
+        callback = CallCounter(mock_callback)
+
+        with FileCache('tests/cache/shared') as fc1:
+            with FileCache('tests/cache/shared') as fc2:
+                path1, deps = fc1.process(callback,importer='test',extension='.tmp',arg=1)
+                path2, deps = fc2.process(callback,importer='test',extension='.tmp',arg=2)
+                self.assertEqual(callback.call_count,2)
+
+                #target created by the other cache is used
+                fc1.process(callback,importer='test',extension='.tmp',arg=2)
+                self.assertEqual(callback.call_count,2)
+
+        with FileCache('tests/cache/shared') as fc:
+            self.assertEqual(len(fc.dependencies),2)
+
+        #no temporary files are left behind
+        files = []
+        for root, dirs, filenames in walk('tests/cache/shared'):
+            files += [f for f in filenames if not f.startswith('.')]
+            self.assertEqual(
+                [f for f in filenames if str(getpid()) in f],
+                []
+            )
+        self.assertEqual(
+            sorted(files),
+            sorted([basename(path1),basename(path2)])
+        )
+
+    def test_shared_cache(self):
+        rmtree('tests/cache/machine',True)
+        for project in ['p1','p2']:
+            makedirs('tests/cache/machine/%s/.mlcache' % project)
+            with open('tests/cache/machine/%s/dep1' % project,'w','utf8') as fid:
+                fid.write('foo')
+        def callback(fn,**kwargs):
+            with open(fn,'w','utf8') as fid:
+                fid.write('bar')
+            return [join(dirname(dirname(fn)),'dep1')]
+        callback = CallCounter(callback)
+
+        paths = []
+        for project in ['p1','p2']:
+            with FileCache('tests/cache/machine/%s/.mlcache' % project,
+                    shared='tests/cache/machine/shared') as fc:
+                path, deps = fc.process(callback,importer='test',extension='.tmp',arg=1)
+                self.assertEqual(abspath(deps[0]),abspath('tests/cache/machine/%s/dep1' % project))
+                paths.append(path)
+        self.assertEqual(callback.call_count,1)
+        self.assertEqual(lstat(paths[0]).st_ino,lstat(paths[1]).st_ino)
+
+        #different dependency contents are rendered separately
+        with open('tests/cache/machine/p2/dep1','w','utf8') as fid:
+            fid.write('baz')
+        with FileCache('tests/cache/machine/p2/.mlcache',
+                shared='tests/cache/machine/shared') as fc:
+            fc.process(callback,importer='test',extension='.tmp',arg=1)
+        self.assertEqual(callback.call_count,2)
+
+    def test_shared_gc(self):
+        rmtree('tests/cache/shared_gc',True)
+        makedirs('tests/cache/shared_gc')
+        shared = SharedCache('tests/cache/shared_gc/shared')
+        for name, size in [('old',10),('new',20)]:
+            path = 'tests/cache/shared_gc/%s.tmp' % name
+            with open(path,'w','utf8') as fid:
+                fid.write(name*size)
+            shared.publish(name,path,[])
+            shared._used().set(shared.variants(name)[0]["object"],1000 + size)
+        orphan = 'tests/cache/shared_gc/shared/objects/00/orphan.tmp'
+        makedirs(dirname(orphan))
+        open(orphan,'w','utf8').close()
+
+        #recently added objects are kept
+        self.assertEqual(shared.gc(0),[])
+
+        #unused objects go first, then the least recently used
+        removed = shared.gc(60,grace=0)
+        self.assertEqual(len(removed),2)
+        self.assertFalse(exists(orphan))
+        self.assertEqual(shared.variants('old'),[])
+        self.assertEqual(len(shared.variants('new')),1)
+        shared.close()
+
+    def test_concurrent_publish(self):
+        rmtree('tests/cache/publish',True)
+        makedirs('tests/cache/publish')
+        path = 'tests/cache/publish/shared'
+        publishers = [Process(target=variant_publisher,args=(path,n))
+            for n in range(4)]
+        for publisher in publishers:
+            publisher.start()
+        for publisher in publishers:
+            publisher.join()
+
+        #no process drops the variants of the other
+        shared = SharedCache(path)
+        self.assertEqual(len(shared.variants('target')),SharedCache.max_variants)
+        shared.close()
+
+    def test_migrate(self):
+        rmtree('tests/cache/migrate',True)
+        makedirs('tests/cache/migrate')
+        callback = CallCounter(mock_callback)
+        with FileCache('tests/cache/migrate') as fc:
+            path, deps = fc.process(callback,importer='test',extension='.tmp',arg=1)
+
+        #move to flat layout of older versions, which wrote the
+        #dependencies as a single dictionary without newline
+        flat_path = join('tests/cache/migrate',basename(path))
+        rename(path,flat_path)
+        remove('tests/cache/migrate/.layout')
+        target_id = basename(path).split('.')[0]
+        with open('tests/cache/migrate/.deps','w','utf8') as fid:
+            fid.write(json.dumps({target_id : deps}))
+
+        with FileCache('tests/cache/migrate') as fc:
+            fc.process(callback,importer='test',extension='.tmp',arg=1)
+        self.assertEqual(callback.call_count,1)
+        self.assertTrue(exists(path))
+        self.assertFalse(exists(flat_path))
+
+    def test_failures(self):
+        rmtree('tests/cache/failures',True)
+        makedirs('tests/cache/failures')
+        open('tests/cache/failures/dep1','w','utf8').close()
+        callback = CallCounter(failing_callback)
+
+        with FileCache('tests/cache/failures',failure_backoff=3600) as fc:
+            self.assertRaises(RenderError,fc.process,callback,importer='test',extension='.tmp',arg=4)
+            self.assertEqual(callback.call_count,1)
+
+            #failure is cached
+            self.assertRaises(RenderError,fc.process,callback,importer='test',extension='.tmp',arg=4)
+            self.assertEqual(callback.call_count,1)
+
+        #until a dependency changes
+        with open('tests/cache/failures/dep1','w','utf8') as fid:
+            fid.write('fixed')
+        with FileCache('tests/cache/failures',failure_backoff=3600) as fc:
+            self.assertRaises(RenderError,fc.process,callback,importer='test',extension='.tmp',arg=4)
+            self.assertEqual(callback.call_count,2)
+
+        #or the backoff expires
+        with FileCache('tests/cache/failures',failure_backoff=0) as fc:
+            self.assertRaises(RenderError,fc.process,callback,importer='test',extension='.tmp',arg=4)
+            self.assertEqual(callback.call_count,3)
+
+    def test_stats(self):
+        rmtree('tests/cache/stats',True)
+        makedirs('tests/cache/stats')
+        open('tests/cache/test/dep1','w','utf8').close()
+        callback = CallCounter(mock_callback)
+
+        for i in range(2):
+            with FileCache('tests/cache/stats') as fc:
+                fc.process(callback,importer='test',extension='.tmp',arg=4)
+                fc.process(callback,importer='test',extension='.tmp',arg=4)
+
+        with FileCache('tests/cache/stats') as fc:
+            last = fc.journal('stats')['last']
+            total = fc.journal('stats')['total']
+        self.assertEqual(last["hits"],2)
+        self.assertEqual(last["misses"],{})
+        self.assertEqual(total["hits"],3)
+        self.assertEqual(total["misses"],{'missing_target' : 1})
+
+        #duplicates in a batch are not counted as hits
+        with FileCache('tests/cache/stats') as fc:
+            job = (callback,dict(importer='test',extension='.tmp',arg=5))
+            fc.process_many([job,job])
+            self.assertEqual(fc.stats["hits"],0)
+            self.assertEqual(fc.stats["misses"],{'missing_target' : 1})
+
+    def test_longest_first(self):
+        rmtree('tests/cache/longest',True)
+        makedirs('tests/cache/longest')
+        open('tests/cache/test/dep1','w','utf8').close()
+        order = []
+        def callback(fn,**kwargs):
+            order.append(kwargs["arg"])
+            return mock_callback(fn,**kwargs)
+        jobs = [(callback,dict(importer='test',extension='.tmp',arg=i))
+            for i in range(3)]
+
+        with FileCache('tests/cache/longest') as fc:
+            fc.process_many(jobs)
+            self.assertEqual(sorted(fc.journal('durations').data.keys()),
+                sorted(fc._target(kwargs)[0] for c,kwargs in jobs))
+            #fake history and remove targets
+            for i, (c, kwargs) in enumerate(jobs):
+                target_id, target_path = fc._target(kwargs)
+                fc.journal('durations').set(target_id,[[1,3,2][i],{}])
+                remove(target_path)
+
+        order[:] = []
+        with FileCache('tests/cache/longest') as fc:
+            results = fc.process_many(jobs)
+        self.assertEqual(order,[1,2,0])
+        #results are still in the order of the jobs
+        self.assertEqual(
+            [path for path, deps in results],
+            [fc._target(kwargs)[1] for c, kwargs in jobs]
+        )
+
+    def test_cancel(self):
+        rmtree('tests/cache/cancel',True)
+        makedirs('tests/cache/cancel')
+        open('tests/cache/test/dep1','w','utf8').close()
+        cancelled = Event()
+        started = []
+        delay = [5]
+        def callback(fn,**kwargs):
+            started.append(kwargs["arg"])
+            if kwargs["arg"] == 0:
+                raise RenderError("Failed",[])
+            if cancelled.wait(delay[0]):
+                raise Cancelled()
+            return mock_callback(fn,**kwargs)
+        jobs = [(callback,dict(importer='test',extension='.tmp',arg=i))
+            for i in range(4)]
+
+        with FileCache('tests/cache/cancel',jobs=2,failure_backoff=60) as fc:
+            fc.on_cancel(cancelled.set)
+            self.assertRaises(RenderError,fc.process_many,jobs)
+            self.assertTrue(cancelled.is_set())
+            self.assertTrue(len(started) < 4)
+            #only the failure is remembered
+            self.assertEqual(len(fc.journal('failures').data),1)
+            self.assertEqual(fc.journal('deps').data,{})
+
+        #the others are still created with keep_going
+        cancelled.clear()
+        delay[0] = 0
+        with FileCache('tests/cache/cancel',jobs=2,keep_going=True) as fc:
+            fc.on_cancel(cancelled.set)
+            self.assertRaises(RenderError,fc.process_many,jobs)
+            self.assertFalse(cancelled.is_set())
+            self.assertEqual(len(fc.journal('deps').data),3)
+
+    def test_interrupt(self):
+        rmtree('tests/cache/interrupt',True)
+        makedirs('tests/cache/interrupt')
+        open('tests/cache/test/dep1','w','utf8').close()
+        def interrupted(fn,**kwargs):
+            if kwargs["arg"] == 3:
+                raise KeyboardInterrupt()
+            return mock_callback(fn,**kwargs)
+        jobs = [(interrupted,dict(importer='test',extension='.tmp',arg=i))
+            for i in range(4)]
+
+        with FileCache('tests/cache/interrupt') as fc:
+            self.assertRaises(KeyboardInterrupt,fc.process_many,jobs)
+
+        #the targets created before the interrupt are kept
+        callback = CallCounter(mock_callback)
+        jobs = [(callback,kwargs) for c, kwargs in jobs]
+        with FileCache('tests/cache/interrupt') as fc:
+            fc.process_many(jobs)
+            self.assertEqual(callback.call_count,1)
+            self.assertEqual(fc.stats["misses"],{'missing_target' : 1})
+
+        #other errors cancel the remaining jobs as well
+        cancelled = Event()
+        def broken(fn,**kwargs):
+            if kwargs["arg"] == 4:
+                raise OSError("No such file or directory")
+            if cancelled.wait(5):
+                raise Cancelled()
+            return mock_callback(fn,**kwargs)
+        jobs = [(broken,dict(importer='test',extension='.tmp',arg=i))
+            for i in range(4,8)]
+        with FileCache('tests/cache/interrupt',jobs=2) as fc:
+            fc.on_cancel(cancelled.set)
+            self.assertRaises(OSError,fc.process_many,jobs)
+            self.assertTrue(cancelled.is_set())
+
+    def test_all_at_once(self):
+        rmtree('tests/cache/all_at_once',True)
+        makedirs('tests/cache/all_at_once')
+        running = []
+        def callback(fn,**kwargs):
+            #only finishes if all callbacks run at the same time
+            running.append(kwargs["arg"])
+            start = time()
+            while len(running) < 6 and time() - start < 5:
+                sleep(0.01)
+            if len(running) < 6:
+                raise RenderError("Not run at once")
+            open(fn,'w','utf8').close()
+            return []
+        jobs = [(callback,dict(importer='test',extension='.tmp',arg=i))
+            for i in range(6)]
+        with FileCache('tests/cache/all_at_once',jobs=None) as fc:
+            fc.process_many(jobs)
+
+    def test_status(self):
+        rmtree('tests/cache/status',True)
+        makedirs('tests/cache/status')
+        open('tests/cache/test/dep1','w','utf8').close()
+        callback = CallCounter(mock_callback)
+        jobs = [(callback,dict(importer='test',extension='.tmp',arg=i))
+            for i in range(2)]
+
+        with FileCache('tests/cache/status') as fc:
+            fc.process_many(jobs[:1])
+            status = fc.status(jobs)
+        self.assertEqual(callback.call_count,1)
+        self.assertEqual([s["state"] for s in status],['fresh','stale'])
+        self.assertEqual([s["reason"] for s in status],[None,'missing_target'])
+        self.assertFalse(status[0]["estimate"] is None)
+        self.assertTrue(status[1]["estimate"] is None)
+
+    def test_read_only(self):
+        rmtree('tests/cache/read_only',True)
+        makedirs('tests/cache/read_only')
+        open('tests/cache/test/dep1','w','utf8').close()
+        open('tests/cache/read_only/doc','w','utf8').close()
+        callback = CallCounter(mock_callback)
+        jobs = [(callback,dict(importer='test',extension='.tmp',arg=i))
+            for i in range(2)]
+        with FileCache('tests/cache/read_only') as fc:
+            fc.process_many(jobs[:1])
+
+        def contents():
+            res = {}
+            for path, dirs, files in walk('tests/cache/read_only'):
+                for name in files:
+                    res[join(path,name)] = open(join(path,name),'rb').read()
+            return res
+        before = contents()
+
+        with FileCache('tests/cache/read_only',check='content',
+                read_only=True) as fc:
+            status = fc.status(jobs)
+            self.assertEqual(fc.parsed('tests/cache/read_only/doc',basename),'doc')
+        self.assertEqual([s["state"] for s in status],['fresh','stale'])
+        self.assertEqual(contents(),before)
+
+    def test_index(self):
+        rmtree('tests/cache/index',True)
+        makedirs('tests/cache/index')
+        with open('tests/cache/index/blob','w','utf8') as fid:
+            fid.write('blob')
+        checksum = CallCounter(lambda fid: 'checksum %s' % fid.read())
+
+        #just modified files could change again unnoticed, so they are
+        #hashed every time
+        for i in range(2):
+            with FileCache('tests/cache/index') as fc:
+                index = fc.index('blob_ids',checksum)
+                self.assertEqual(index.digest('tests/cache/index/blob'),'checksum blob')
+        self.assertEqual(checksum.call_count,2)
+
+        past = time() - 10
+        utime('tests/cache/index/blob',(past,past))
+        for i in range(2):
+            with FileCache('tests/cache/index') as fc:
+                index = fc.index('blob_ids',checksum)
+                self.assertEqual(index.digest('tests/cache/index/blob'),'checksum blob')
+        self.assertEqual(checksum.call_count,3)
+
+        #hashed again after a modification
+        with open('tests/cache/index/blob','w','utf8') as fid:
+            fid.write('modified blob')
+        utime('tests/cache/index/blob',(past,past))
+        with FileCache('tests/cache/index') as fc:
+            index = fc.index('blob_ids',checksum)
+            self.assertEqual(index.digest('tests/cache/index/blob'),'checksum modified blob')
+        self.assertEqual(checksum.call_count,4)
+
+        #entries of removed files are pruned by gc
+        with open('tests/cache/index/keep','w','utf8') as fid:
+            fid.write('keep')
+        utime('tests/cache/index/keep',(past,past))
+        with FileCache('tests/cache/index') as fc:
+            fc.index('blob_ids',checksum).digest('tests/cache/index/keep')
+        remove('tests/cache/index/blob')
+        with FileCache('tests/cache/index') as fc:
+            self.assertEqual(len(fc.journal('blob_ids').data),2)
+            fc.gc()
+            self.assertEqual(len(fc.journal('blob_ids').data),1)
+            self.assertEqual(fc.journal('blob_ids').data.values()[0][3],
+                abspath('tests/cache/index/keep'))
+
+    def test_prefetch(self):
+        rmtree('tests/cache/prefetch',True)
+        makedirs('tests/cache/prefetch')
+        #large enough to be memory mapped
+        with open('tests/cache/prefetch/large','wb') as fid:
+            fid.write('large'*MMAP_SIZE)
+        past = time() - 10
+        utime('tests/cache/prefetch/large',(past,past))
+        with open('tests/cache/prefetch/large','rb') as fid:
+            expected = file_digest(fid)
+        with MappedFile('tests/cache/prefetch/large') as fid:
+            self.assertEqual(fid.read(5),'large')
+            self.assertEqual(str(fid.read_buffer(5)),'large')
+            self.assertEqual(len(fid.read()),5*MMAP_SIZE - 10)
+            self.assertEqual(len(fid.read_buffer()),0)
+
+        with FileCache('tests/cache/prefetch') as fc:
+            index = fc.index('digests')
+            index.prefetch(['tests/cache/prefetch/large'])
+            self.assertEqual(len(index.pending),1)
+            self.assertEqual(fc.digest('tests/cache/prefetch/large'),expected)
+            self.assertEqual(index.pending,{})
+
+        with FileCache('tests/cache/prefetch') as fc:
+            #already known
+            fc.index('digests').prefetch(['tests/cache/prefetch/large'])
+            self.assertEqual(fc.index('digests').pending,{})
+
+    def test_parsed(self):
+        rmtree('tests/cache/parsed',True)
+        makedirs('tests/cache/parsed/.mlcache')
+        with open('tests/cache/parsed/doc.yaml','w','utf8') as fid:
+            fid.write('title: First\n---\ntitle: Second\n')
+        parse = CallCounter(parse_yaml)
+
+        for i in range(2):
+            with FileCache('tests/cache/parsed/.mlcache') as fc:
+                inst = fc.parsed('tests/cache/parsed/doc.yaml',parse)
+                self.assertEqual(inst,{'title' : 'First'})
+        self.assertEqual(parse.call_count,1)
+
+        #parsed again after a modification, only the new version is kept
+        with open('tests/cache/parsed/doc.yaml','w','utf8') as fid:
+            fid.write('title: Modified\n')
+        with FileCache('tests/cache/parsed/.mlcache') as fc:
+            inst = fc.parsed('tests/cache/parsed/doc.yaml',parse)
+            self.assertEqual(inst,{'title' : 'Modified'})
+        self.assertEqual(parse.call_count,2)
+        self.assertEqual(len(listdir('tests/cache/parsed/.mlcache/.marshalled')),1)
+
+        #and shared within the process
+        self.assertTrue(load_yaml('tests/cache/parsed/doc.yaml') is
+            load_yaml('tests/cache/parsed/doc.yaml'))
+
+        #documents can not construct python objects
+        with open('tests/cache/parsed/evil.yaml','w','utf8') as fid:
+            fid.write('a: !!python/object/apply:os.getpid []\n')
+        self.assertRaises(yaml.YAMLError,parse_yaml,'tests/cache/parsed/evil.yaml')
+
+        #dates can not be marshalled and are parsed each time
+        with open('tests/cache/parsed/date.yaml','w','utf8') as fid:
+            fid.write('date: 2014-09-16\n')
+        with FileCache('tests/cache/parsed/.mlcache') as fc:
+            inst = fc.parsed('tests/cache/parsed/date.yaml',parse)
+            self.assertEqual(inst["date"].year,2014)
+
+        #empty documents are left to the validation
+        with open('tests/cache/parsed/empty.yaml','w','utf8') as fid:
+            fid.write('')
+        self.assertEqual(parse_yaml('tests/cache/parsed/empty.yaml'),None)
+        self.assertEqual(len(listdir('tests/cache/parsed/.mlcache/.marshalled')),1)
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size("100"),100)
+        self.assertEqual(parse_size("2k"),2048)
+        self.assertEqual(parse_size("3 MB"),3*1024**2)
+        self.assertEqual(parse_size("1GiB"),1024**3)
+        self.assertEqual(parse_size(None),None)
+        self.assertRaises(ValueError,parse_size,"a lot")
+
+class JobQueueTest(unittest.TestCase):
+    def test_queue(self):
+        rmtree('tests/cache/queue',True)
+        makedirs('tests/cache/queue')
+        with open('tests/cache/queue/input','w','utf8') as fid:
+            fid.write('input')
+
+        queue = JobQueue('tests/cache/queue/jobs')
+        digest = queue.put_blob('tests/cache/queue/input')
+        first = queue.submit(dict(files={'input' : digest}))
+        second = queue.submit(dict(files={}))
+
+        #jobs are claimed once, in order, and start with a fresh lease
+        pending = 'tests/cache/queue/jobs/pending/%s.json' % first
+        utime(pending,(time() - 120,time() - 120))
+        job_id, job = queue.claim()
+        self.assertEqual(job_id,first)
+        self.assertFalse(queue._expired(job_id))
+        self.assertEqual(queue.claim()[0],second)
+        self.assertEqual(queue.claim(),None)
+
+        queue.get_blob(job["files"]["input"],'tests/cache/queue/work/input')
+        self.assertEqual(open('tests/cache/queue/work/input').read(),'input')
+        queue.finish(job_id,dict(deps=['input']),'tests/cache/queue/work/input')
+        queue.finish(second,dict(error='Failed',deps=[]))
+
+        result = queue.collect(first,'tests/cache/queue/target')
+        self.assertEqual(result,dict(deps=['input']))
+        self.assertTrue(exists('tests/cache/queue/target'))
+        result = queue.collect(second,'tests/cache/queue/target2')
+        self.assertEqual(result["error"],'Failed')
+        self.assertFalse(exists('tests/cache/queue/target2'))
+        self.assertEqual(listdir('tests/cache/queue/jobs/done'),[])
+
+    def test_interrupted_collect(self):
+        rmtree('tests/cache/interrupted_collect',True)
+        queue = JobQueue('tests/cache/interrupted_collect/jobs')
+        job_id = queue.submit(dict(files={}))
+        class Interrupt:
+            def is_set(self):
+                raise KeyboardInterrupt()
+
+        #the job is withdrawn
+        self.assertRaises(KeyboardInterrupt,queue.collect,
+            job_id,'tests/cache/interrupted_collect/target',
+            cancelled=Interrupt())
+        self.assertEqual(queue.claim(),None)
+
+    def test_put_blob(self):
+        rmtree('tests/cache/put_blob',True)
+        makedirs('tests/cache/put_blob')
+        with open('tests/cache/put_blob/input','w','utf8') as fid:
+            fid.write('input')
+
+        queue = JobQueue('tests/cache/put_blob/jobs')
+        pool = ThreadPool(8)
+        digests = pool.map(queue.put_blob,['tests/cache/put_blob/input']*32)
+        pool.close()
+        pool.join()
+        self.assertEqual(len(set(digests)),1)
+        for path, dirs, files in walk('tests/cache/put_blob/jobs/blobs'):
+            for name in files:
+                self.assertEqual(name,digests[0])
+
+        #the blob is a copy, so editing the file does not change it
+        blob = 'tests/cache/put_blob/jobs/blobs/%s/%s' % \
+            (digests[0][:2],digests[0])
+        self.assertNotEqual(
+            lstat(blob).st_ino,
+            lstat('tests/cache/put_blob/input').st_ino
+        )
+        with open('tests/cache/put_blob/input','w','utf8') as fid:
+            fid.write('edited')
+        self.assertEqual(open(blob).read(),'input')
+
+    def test_gc(self):
+        rmtree('tests/cache/queue_gc',True)
+        makedirs('tests/cache/queue_gc')
+        queue = JobQueue('tests/cache/queue_gc/jobs')
+        digests = []
+        for name in ['pending','running','done']:
+            path = 'tests/cache/queue_gc/%s' % name
+            with open(path,'w','utf8') as fid:
+                fid.write(name)
+            digests.append(queue.put_blob(path))
+        queue.submit(dict(files={'running' : digests[1]}))
+        job_id, job = queue.claim()
+        queue.submit(dict(files={'pending' : digests[0]}))
+
+        #recently stored blobs are kept
+        self.assertEqual(queue.gc(),[])
+
+        #blobs that no job needs are removed
+        self.assertEqual(queue.gc(grace=0),[digests[2]])
+        queue.finish(job_id,dict(deps=[]))
+        self.assertEqual(queue.gc(grace=0),[digests[1]])
+
+    def test_expired(self):
+        rmtree('tests/cache/expired',True)
+        queue = JobQueue('tests/cache/expired/jobs')
+        job_id = queue.submit(dict(files={}))
+        self.assertEqual(queue.claim()[0],job_id)
+        running = 'tests/cache/expired/jobs/running/%s.json' % job_id
+        utime(running,(time() - 120,time() - 120))
+
+        #a job whose worker stopped renewing the lease is given up
+        self.assertRaises(RenderError,queue.collect,
+            job_id,'tests/cache/expired/target')
+        self.assertFalse(exists(running))
+
+        #and its result is discarded
+        queue.finish(job_id,dict(deps=[]))
+        queue.release(job_id)
+        self.assertEqual(listdir('tests/cache/expired/jobs/done'),[])
+        self.assertEqual(listdir('tests/cache/expired/jobs/pending'),[])
+
+        #as is a job that runs for too long, even if its lease is renewed
+        queue = JobQueue('tests/cache/expired/jobs',lease=0.3)
+        job_id = queue.submit(dict(files={}))
+        self.assertEqual(queue.claim()[0],job_id)
+        stop = queue.keep_alive(job_id)
+        start = time()
+        try:
+            self.assertRaises(RenderError,queue.collect,
+                job_id,'tests/cache/expired/target',timeout=0.5,grace=0.5)
+        finally:
+            stop.set()
+        self.assertTrue(time() - start > 1.)
+
+class JournalTest(unittest.TestCase):
+    def test_journal(self):
+        rmtree('tests/cache/journal',True)
+        makedirs('tests/cache/journal')
+        journal = Journal('tests/cache/journal/.test')
+        journal.set('a',1)
+        journal.set('b',[2])
+        journal.set('a',3)
+        journal.delete('b')
+        journal.close()
+
+        journal = Journal('tests/cache/journal/.test')
+        self.assertEqual(journal.data,{'a' : 3})
+        self.assertEqual(journal.records,4)
+        journal.compact()
+
+        journal = Journal('tests/cache/journal/.test')
+        self.assertEqual(journal.data,{'a' : 3})
+        self.assertEqual(journal.records,1)
+
+    def test_interrupted(self):
+        rmtree('tests/cache/interrupted',True)
+        makedirs('tests/cache/interrupted')
+        with open('tests/cache/interrupted/.test','w','utf8') as fid:
+            fid.write('{"a" : 1}\n["b", 2]\n["c", ')
+        journal = Journal('tests/cache/interrupted/.test')
+        self.assertEqual(journal.data,{'a' : 1, 'b' : 2})
+        journal.set('d',4)
+        journal.close()
+
+        journal = Journal('tests/cache/interrupted/.test')
+        self.assertEqual(journal.data,{'a' : 1, 'b' : 2, 'd' : 4})
+
+    def test_legacy(self):
+        rmtree('tests/cache/legacy',True)
+        makedirs('tests/cache/legacy')
+        with open('tests/cache/legacy/.test','w','utf8') as fid:
+            fid.write(json.dumps({'a' : 1, 'b' : [2]}))
+        journal = Journal('tests/cache/legacy/.test')
+        self.assertEqual(journal.data,{'a' : 1, 'b' : [2]})
+        journal.set('c',3)
+        journal.close()
+
+        journal = Journal('tests/cache/legacy/.test')
+        self.assertEqual(journal.data,{'a' : 1, 'b' : [2], 'c' : 3})
+
+    def test_merge(self):
+        rmtree('tests/cache/merge',True)
+        makedirs('tests/cache/merge')
+        journal1 = Journal('tests/cache/merge/.test')
+        journal2 = Journal('tests/cache/merge/.test')
+        journal1.set('a',1)
+        journal2.set('b',2)
+        journal2.compact()
+        journal1.set('c',3)
+        self.assertEqual(journal2.refresh(),{'a' : 1, 'b' : 2, 'c' : 3})
+        journal1.close()
+        journal2.close()
+
+        journal = Journal('tests/cache/merge/.test')
+        self.assertEqual(journal.data,{'a' : 1, 'b' : 2, 'c' : 3})
+
+    def test_concurrent_compaction(self):
+        rmtree('tests/cache/compaction',True)
+        makedirs('tests/cache/compaction')
+        path = 'tests/cache/compaction/.test'
+        writers = [Process(target=journal_writer,args=(path,n))
+            for n in range(6)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+
+        #no process loses the records of the others
+        data = Journal(path).data
+        self.assertEqual(len(data),6*31)
+        for n in range(6):
+            self.assertEqual(data['counter-%d' % n],4)
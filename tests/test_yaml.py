@@ -1,15 +1,30 @@
 import unittest
 from datetime import timedelta
+from threading import Thread, Event
+from time import sleep
 
 from codecs import open
-from os import makedirs
-from os.path import join,dirname, exists
-from shutil import rmtree
+from os import makedirs, listdir, chmod
+from os.path import join,dirname, exists, basename, abspath
+import signal
+from socket import gethostname
+from subprocess import Popen
+from shutil import rmtree, copyfile
 
-from manufac.utils import FileCache
+from manufac.utils import FileCache, RenderError, Cancelled, JobQueue
+from manufac.utils import load_yaml
+from manufac.utils import new_stats
 from manufac.importers.common import GraphScaffolding, parse_time, format_time
-from manufac.importers.openscad import OpenSCADImporter
+from manufac.importers.common import load_documents, IncludeCycleError
+from manufac.importers.common import validate_document, get_validator
+import manufac.importers.common as importers
+from manufac.importers.openscad import OpenSCADImporter, FakeRenderer
+from manufac.importers.openscad import OpenSCADRenderer
+from manufac.importers.openscad import Scratch, get_renderer, run_worker
+import manufac.importers.openscad as openscad
 from manuallabour.core.common import Step
+import jsonschema
+from jsonschema import ValidationError
 from manuallabour.core.stores import LocalMemoryStore
 from manuallabour.core.graph import GraphStep
 from manuallabour.exporters.svg import GraphSVGExporter
@@ -71,6 +86,385 @@ class TestYAML(unittest.TestCase):
             2
         )
 
+class TestInclude(unittest.TestCase):
+    def setUp(self):
+        self.store = LocalMemoryStore()
+        cachedir = join('tests/output/.mlcache')
+        if not exists(cachedir):
+            makedirs(cachedir)
+        self.cache = FileCache(cachedir)
+        self.cache.clear()
+
+    def test_cycle(self):
+        #detected before anything is rendered
+        self.assertRaises(
+            IncludeCycleError,
+            load_documents,
+            'tests/yaml/cycle_a.yaml',
+            self.cache
+        )
+        self.assertRaises(
+            IncludeCycleError,
+            GraphScaffolding,
+            'tests/yaml/cycle_a.yaml',
+            self.store,
+            self.cache,
+            []
+        )
+
+    def test_diamond(self):
+        documents = load_documents('tests/yaml/diamond.yaml',self.cache)
+        self.assertEqual(
+            sorted(basename(filename) for filename, inst in documents),
+            ['diamond.yaml','diamond_left.yaml',
+             'diamond_right.yaml','diamond_shared.yaml']
+        )
+
+        scaf = GraphScaffolding(
+            'tests/yaml/diamond.yaml',
+            self.store,
+            self.cache,
+            []
+        )
+        left = scaf.include['left']
+        right = scaf.include['right']
+        self.assertTrue(left.include['shared'] is right.include['shared'])
+
+    def test_nested(self):
+        scaf = GraphScaffolding(
+            'tests/yaml/chain.yaml',
+            self.store,
+            self.cache,
+            []
+        )
+        graph = scaf.get_graph()
+        self.assertTrue(scaf.get_graph() is graph)
+
+        #the steps required from the includes, directly or indirectly
+        mid = scaf.include['mid'].get_graph()
+        expected = set(scaf.step_ids.values())
+        for step_id in scaf.included_steps['mid']:
+            expected.add(step_id)
+            expected.update(mid.all_ancestors(step_id))
+        self.assertEqual(set(step.step_id for step in graph.steps),expected)
+        self.assertEqual(len(graph.steps),4)
+
+        #the shared step is in the graph once
+        step_ids = [step["step_id"] for step in scaf._graph_steps()]
+        self.assertEqual(len(step_ids),4)
+        self.assertEqual(len(set(step_ids)),4)
+
+class TestValidation(unittest.TestCase):
+    def setUp(self):
+        cachedir = join('tests/output/.mlcache')
+        if not exists(cachedir):
+            makedirs(cachedir)
+        self.cache = FileCache(cachedir)
+        self.cache.clear()
+
+    def test_invalid(self):
+        #fail with a schema error before anything is rendered
+        for name in ['empty','step','include']:
+            path = 'tests/yaml/invalid_%s.yaml' % name
+            with self.cache:
+                self.assertRaises(
+                    ValidationError,
+                    load_documents,
+                    path,
+                    self.cache
+                )
+                self.assertEqual(self.cache.stats,new_stats())
+            self.assertRaises(ValidationError,load_documents,path)
+
+    def test_cached(self):
+        path = 'tests/output/validated.yaml'
+        copyfile('tests/yaml/simple.yaml',path)
+        calls = []
+        validate = importers.validate
+        def counting(inst,schema_name):
+            calls.append(schema_name)
+            validate(inst,schema_name)
+        importers.validate = counting
+        try:
+            for i in range(2):
+                with self.cache:
+                    validate_document(path,load_yaml(path),self.cache)
+            self.assertEqual(len(calls),1)
+
+            #an edited document is validated again
+            with open(path,'a','utf8') as fid:
+                fid.write('#edited\n')
+            with self.cache:
+                validate_document(path,load_yaml(path),self.cache)
+            self.assertEqual(len(calls),2)
+
+            #all documents are validated again when the schemas change
+            importers._schema_version = 'changed'
+            with self.cache:
+                validate_document(path,load_yaml(path),self.cache)
+            self.assertEqual(len(calls),3)
+        finally:
+            importers.validate = validate
+            importers._schema_version = None
+
+    def test_validator(self):
+        #compiled once per process
+        self.assertTrue(get_validator('ml.json') is get_validator('ml.json'))
+
+        #references are resolved from the bundled schemas
+        validators = importers._validators
+        resolve_remote = jsonschema.RefResolver.resolve_remote
+        def fetch(resolver,url):
+            raise AssertionError("Fetched %s" % url)
+        importers._validators = {}
+        jsonschema.RefResolver.resolve_remote = fetch
+        try:
+            importers.validate(load_yaml('tests/yaml/simple.yaml'),'ml.json')
+        finally:
+            jsonschema.RefResolver.resolve_remote = resolve_remote
+            importers._validators = validators
+
+class TestOpenSCAD(unittest.TestCase):
+    def setUp(self):
+        self.store = LocalMemoryStore()
+        cachedir = join('tests/output/.mlcache')
+        if not exists(cachedir):
+            makedirs(cachedir)
+        self.cache = FileCache(cachedir)
+        self.cache.clear()
+        self.documents = load_documents('tests/yaml/openscad.yaml')
+
+    def build(self,os_imp):
+        #builds openscad.yaml, returns the scaffolding and the cache stats
+        with self.cache:
+            os_imp.prepare(self.cache,self.documents)
+            scaf = GraphScaffolding(
+                'tests/yaml/openscad.yaml',
+                self.store,
+                self.cache,
+                [os_imp]
+            )
+            return scaf, dict(self.cache.stats)
+
+    def test_canonical_jobs(self):
+        os_imp = OpenSCADImporter('tests/yaml')
+        inst = load_yaml('tests/yaml/openscad.yaml')
+        jobs = os_imp._jobs(inst["steps"])[0]
+        self.assertEqual(len(jobs),6)
+
+        #names and filenames do not change the render
+        targets = set(self.cache.target_id(kwargs) for c, kwargs in jobs)
+        self.assertEqual(len(targets),4)
+
+    def test_get_renderer(self):
+        renderer = get_renderer('fake:latency=0.5, size=2048',timeout=3)
+        self.assertTrue(isinstance(renderer,FakeRenderer))
+        self.assertEqual(renderer.latency,0.5)
+        self.assertEqual(renderer.size,2048)
+        self.assertEqual(renderer.timeout,3.)
+        self.assertRaises(ValueError,get_renderer,'povray')
+
+    def test_deterministic(self):
+        #a fresh cache gets the same images
+        scaf, stats = self.build(OpenSCADImporter('tests/yaml',renderer='fake'))
+        blob_id = scaf.steps_out['s1']['images']['chb']['blob_id']
+
+        self.cache.clear()
+        scaf, stats = self.build(OpenSCADImporter('tests/yaml',renderer='fake'))
+        self.assertEqual(stats["misses"],{'missing_target' : 4})
+        self.assertEqual(
+            scaf.steps_out['s1']['images']['chb']['blob_id'],
+            blob_id
+        )
+
+    def test_geometry(self):
+        os_imp = OpenSCADImporter('tests/yaml',geometry=True,renderer='fake')
+        scaf, stats = self.build(os_imp)
+
+        #three modules are evaluated, the four outputs derived from them
+        self.assertEqual(stats["misses"],{'missing_target' : 7})
+        with self.cache:
+            plan = os_imp.plan(self.cache,self.documents)
+        self.assertEqual(set(status["state"] for status in plan),set(['fresh']))
+
+        #derived files report the sources of the geometry
+        sourcefiles = scaf.steps_out['s1']['files']['chb']['sourcefiles']
+        self.assertEqual(
+            sorted(f["filename"] for f in sourcefiles),
+            ['M12_CameraCaseAssy.scad','include.scad']
+        )
+
+    def test_batch(self):
+        #the jobs of all steps are merged, each render runs once
+        scaf, stats = self.build(OpenSCADImporter('tests/yaml',renderer='fake'))
+        self.assertEqual(stats["misses"],{'missing_target' : 4})
+        self.assertEqual(stats["hits"],0)
+        self.assertEqual(
+            len(scaf.steps_out['s1']['images']['chb']['sourcefiles']),
+            2
+        )
+
+        scaf, stats = self.build(OpenSCADImporter('tests/yaml',renderer='fake'))
+        self.assertEqual(stats["misses"],{})
+        self.assertEqual(stats["hits"],4)
+
+    def test_reuse(self):
+        #an importer used for several builds checks the cache each time
+        os_imp = OpenSCADImporter('tests/yaml',renderer='fake')
+        self.build(os_imp)
+        self.cache.clear()
+        scaf, stats = self.build(os_imp)
+        self.assertEqual(stats["misses"],{'missing_target' : 4})
+        self.assertEqual(stats["hits"],0)
+
+    def test_queue(self):
+        queue = 'tests/output/queue'
+        rmtree(queue,True)
+        os_imp = OpenSCADImporter('tests/yaml',queue=queue,renderer='fake')
+
+        done = Event()
+        def work():
+            while not done.is_set():
+                run_worker(JobQueue(queue),once=True,renderer='fake')
+                sleep(0.01)
+        worker = Thread(target=work)
+        worker.start()
+        try:
+            scaf, stats = self.build(os_imp)
+        finally:
+            done.set()
+            worker.join()
+
+        self.assertEqual(stats["misses"],{'missing_target' : 4})
+        self.assertEqual(
+            len(scaf.steps_out['s1']['images']['chb']['sourcefiles']),
+            2
+        )
+        for name in ['pending','running','done']:
+            self.assertEqual(listdir(join(queue,name)),[])
+
+    def test_invalid(self):
+        #requests can not reach files outside of the workspace
+        rmtree('tests/output/invalid',True)
+        queue = JobQueue('tests/output/invalid/queue')
+        for invalid in [dict(basedir='..'),dict(extension='/../../x'),
+                dict(kwargs=dict(scadfile='../../a.scad')),
+                dict(kwargs=dict(scadfile='a.scad',geometry_path='/g.stl'))]:
+            request = dict(
+                options=[],
+                kwargs=dict(scadfile='a.scad'),
+                basedir='.',
+                extension='.png',
+                files={}
+            )
+            request.update(invalid)
+            job_id = queue.submit(request)
+            run_worker(queue,once=True,renderer='fake')
+            result = queue.collect(job_id,'tests/output/invalid/target')
+            self.assertTrue(result["error"].startswith('Worker failed'))
+        self.assertFalse(exists('tests/output/invalid/target'))
+
+    def test_scratch(self):
+        rmtree('tests/output/scratch',True)
+        makedirs('tests/output/scratch')
+        scratch = Scratch('tests/output/scratch')
+        path = scratch.wrapper('cube();\n')
+        self.assertEqual(scratch.wrapper('cube();\n'),path)
+        self.assertNotEqual(scratch.wrapper('sphere();\n'),path)
+        self.assertTrue(scratch.contains(path))
+        scratch.close()
+        self.assertFalse(exists(path))
+
+        #wrappers and temporary files do not end up in the project
+        os_imp = OpenSCADImporter(
+            'tests/yaml',
+            renderer='fake',
+            scratch='tests/output/scratch'
+        )
+        self.build(os_imp)
+        #one wrapper for each module
+        self.assertEqual(len(listdir(os_imp.scratch.path)),3)
+        self.assertTrue(all(name.endswith('.scad')
+            for name in listdir(os_imp.scratch.path)))
+        os_imp.scratch.close()
+
+    def test_stale(self):
+        #only directories of dead processes on this host are removed
+        rmtree('tests/output/stale',True)
+        proc = Popen(['true'])
+        proc.wait()
+        local = 'manufac-scratch-%s-%d-x' % \
+            (gethostname().replace('-','_'),proc.pid)
+        other = 'manufac-scratch-otherhost-%d-x' % proc.pid
+        worker = 'manufac-worker-%s-%d-x' % \
+            (gethostname().replace('-','_'),proc.pid)
+        for name in [local,other,worker]:
+            makedirs(join('tests/output/stale',name))
+
+        scratch = Scratch('tests/output/stale')
+        scratch.wrapper('cube();\n')
+        scratch.close()
+        self.assertFalse(exists(join('tests/output/stale',local)))
+        self.assertTrue(exists(join('tests/output/stale',other)))
+
+        #as well as the workspaces of workers
+        queue = JobQueue('tests/output/stale/queue')
+        run_worker(queue,once=True,renderer='fake',scratch='tests/output/stale')
+        self.assertFalse(exists(join('tests/output/stale',worker)))
+
+    def test_timeout(self):
+        os_imp = OpenSCADImporter(
+            'tests/yaml',
+            renderer='fake:latency=10',
+            timeout=0.1
+        )
+        self.assertRaises(RenderError,self.build,os_imp)
+
+    def sleeper(self):
+        #stands in for OpenSCAD, that hangs
+        rmtree('tests/output/timeout',True)
+        makedirs('tests/output/timeout')
+        path = 'tests/output/timeout/sleeper'
+        with open(path,'w') as fid:
+            fid.write('#!/bin/sh\nsleep 10\n')
+        chmod(path,0755)
+        return OpenSCADRenderer(executable=abspath(path),timeout=0.2)
+
+    def test_limits(self):
+        renderer = self.sleeper()
+        #the CPU limit is a backstop, that never hits before the timeout
+        self.assertTrue(renderer.cpu_time > renderer.timeout)
+
+        #the error output is closed after a timeout
+        fds = len(listdir('/proc/self/fd'))
+        dep_path = 'tests/output/timeout/sleeper.deps'
+        success, err = renderer.run('out.png',[],'in.scad',dep_path)
+        self.assertFalse(success)
+        self.assertTrue('timed out' in err)
+        self.assertEqual(len(listdir('/proc/self/fd')),fds)
+
+    def test_sigterm(self):
+        renderer = self.sleeper()
+        renderer.timeout = None
+        dep_path = 'tests/output/timeout/sleeper.deps'
+        res = []
+        def render():
+            try:
+                renderer.run('out.png',[],'in.scad',dep_path)
+            except Cancelled:
+                res.append('cancelled')
+        thread = Thread(target=render)
+        thread.start()
+        sleep(0.2)
+
+        #the renders are stopped before manufac exits. The handler is
+        #called directly, as cancel_on_sigterm would install it for the
+        #test runner.
+        with self.assertRaises(SystemExit):
+            openscad._terminate(signal.SIGTERM,None)
+        thread.join(5)
+        self.assertEqual(res,['cancelled'])
+
 class TestTime(unittest.TestCase):
     def assertSeconds(self,time,seconds):
         self.assertEqual(timedelta(**parse_time(time)).total_seconds(),seconds)